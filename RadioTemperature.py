@@ -1,29 +1,48 @@
 #!/usr/bin/env python
 
-import json
+import argparse
 import logging
 import os
 import random
 import shutil
+import signal
 import sys
-from datetime import datetime, timedelta
+import threading
+import time
+from contextlib import contextmanager
+from dataclasses import replace
 
 import dbus
 
-import subprocess
 import _thread as thread
 
-from dbus import SessionBus, SystemBus, DBusException
+from dbus import SessionBus, SystemBus
 
-from app_config import AppConfig
+from aggregate import AggregateEngine, AggregateGroup
+from app_config import AppConfig, ConfigWatcher, IngestionType, RTL_433_CONFIG_FILE, create_device, diff_devices
+from dbus_batch import batched
+from discovery import DeviceDiscovery
+from history import SensorHistory
+from ingest import IngestQueue, exceeds_deadband
+from metrics import metrics, messages_received, messages_parsed, messages_dropped, messages_filtered, parse_errors, \
+    update_duration, provider_latency, provider_failures, mqtt_reconnects, RateLimitFilter
 from mqtt_broker import Broker
-from provider import WundergroundProvider, OpenweatherProvider, ProviderType
+from registry import DeviceRegistry, device_key
+from provider import create_provider_chain
+from recorder import TrafficRecorder, replay
+from scheduler import UpdateScheduler
+from state import DeviceState
+from supervisor import Rtl433Pool, Rtl433Supervisor
 from temperature import Temperature, TemperatureType
+from thermal import ThermalSource
+from weather import WeatherFetcher
+from weather_cache import WeatherCache
 
 # add the path to our own packages for import
 sys.path.insert(1, "/data/SetupHelper/velib_python")
 
-from vedbus import VeDbusService, VeDbusItemImport
+from vedbus import VeDbusService
+from gps import GpsTracker
 from gi.repository import GLib
 
 
@@ -31,8 +50,41 @@ def dbus_connection():
     return SessionBus(private=True) if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else SystemBus(private=True)
 
 
-topic_category = {}
-instances = {}
+RTL_433 = '/data/RadioTemperature/bin/rtl_433'
+# seconds between rtl_433 uptime updates on dbus
+MGMT_INTERVAL = 60
+# seconds between saves of the discovered devices
+DISCOVERY_SAVE_INTERVAL = 300
+FIRST_DEVICE_INSTANCE = 40
+# process wide statistics service
+MGMT_SERVICE = 'com.victronenergy.radiotemperature'
+STATS_PATHS = (
+    '/Mgmt/Stats/Messages/Received', '/Mgmt/Stats/Messages/Parsed', '/Mgmt/Stats/Messages/Dropped',
+    '/Mgmt/Stats/Messages/Filtered', '/Mgmt/Stats/Messages/ParseErrors', '/Mgmt/Stats/Update/Count',
+    '/Mgmt/Stats/Update/AverageMs',
+    '/Mgmt/Stats/Provider/Fetches', '/Mgmt/Stats/Provider/AverageMs', '/Mgmt/Stats/Provider/Failures',
+    '/Mgmt/Stats/Mqtt/Reconnects',
+)
+# seconds between updates of the statistics on dbus
+STATS_INTERVAL = 10
+# /Status of temperature services
+STATUS_OK = 0
+STATUS_DISCONNECTED = 1
+# seconds between checks of the configuration file
+CONFIG_CHECK_INTERVAL = 10
+# seconds between flushes of the traffic recording
+RECORD_FLUSH_INTERVAL = 10
+# settings applied without a restart
+RELOADABLE = ('devices', 'tick', 'cpu_interval', 'interval', 'temperature_deadband', 'humidity_deadband', 'debug',
+              'stale_timeout', 'stale_model_timeouts')
+
+registry = DeviceRegistry()
+scheduler = None
+ingest_queue = None
+discovery = None
+recorder = None
+state = None
+device_instances = set()
 
 
 class RadioTemperatureService:
@@ -42,19 +94,37 @@ class RadioTemperatureService:
         self.config = config or AppConfig()
         # temperature class
         self.temperature = device
+        self.key = device_key(device.model, device.channel)
 
         self.dbus_conn = None
+        self.gps = None
+        self.weather = None
         if self.temperature.is_online:
             self.dbus_conn = dbus.SessionBus() if 'DBUS_SESSION_BUS_ADDRESS' in os.environ else dbus.SystemBus()
+            self.gps = GpsTracker(self.dbus_conn, self.config.get_gps())
+            provider = create_provider_chain(self.config.get_providers(), self.config.get_units(),
+                                             self.config.get_connect_timeout(), self.config.get_read_timeout(),
+                                             self.config.get_hedge_delay(), self.config.get_failure_threshold(),
+                                             self.config.get_breaker_cooldown())
+            if provider is not None:
+                cache = WeatherCache(self.config.get_weather_cache_path(), self.config.get_cache_precision(),
+                                     self.config.get_interval() * 60)
+                self.weather = WeatherFetcher(provider, cache)
 
         # dbus service
         logging.debug("* * * %s" % servicename)
-        self.dbusservice = VeDbusService(servicename, bus=dbus_connection(), register=False)
+        self.deviceinstance = deviceinstance
+        self.bus = dbus_connection()
+        self.dbusservice = VeDbusService(servicename, bus=self.bus, register=False)
         self._paths = paths
+        # open batch of path changes, see changes()
+        self._batch = None
 
         self.dbusservice.add_path('/Mgmt/ProcessName', __file__)
         self.dbusservice.add_path('/Mgmt/ProcessVersion', self.config.get_version())
         self.dbusservice.add_path('/Mgmt/Connection', connection)
+        self.dbusservice.add_path('/Mgmt/Rtl433/Restarts', 0)
+        self.dbusservice.add_path('/Mgmt/Rtl433/Uptime', 0)
 
         # Create the mandatory objects
         self.dbusservice.add_path('/DeviceInstance', deviceinstance)
@@ -65,132 +135,137 @@ class RadioTemperatureService:
         self.dbusservice.add_path('/FirmwareVersion', 0x0136)
         self.dbusservice.add_path('/HardwareVersion', 8)
         self.dbusservice.add_path('/Connected', 1)
+        self.connected = True
+        # device type of the configuration, /TemperatureType can be changed on dbus
+        self.configured_type = device.device_type
         self.dbusservice.add_path('/Serial', "xxxx")
 
         for path, settings in self._paths.items():
             self.dbusservice.add_path(
                 path, settings['initial'], writeable=True, onchangecallback=self._handlechangedvalue)
 
+        self.history = None
+        if self.config.get_history():
+            self.history = SensorHistory(self.config.get_history_tiers())
+            for path in self.history.paths():
+                self.dbusservice.add_path(path, None)
+
         self.dbusservice.register()
-        GLib.timeout_add(1000, self._update)
 
-    def _update(self):
-        logging.debug("* * * Updating device info")
+    def update_online(self, callback):
+        logging.debug("* * * Updating online device")
 
-        if not self.is_process_running():
-            logging.debug("* * * rtl is not running: starting again")
-            subprocess.Popen(['/data/RadioTemperature/bin/rtl_433', '-c', "/data/conf/rtl.conf"],
-                             stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        if self.weather is None:
+            logging.debug("* * * not valid provider.")
+            return False
 
-        if self.temperature.is_online:
+        position = self.gps.position()
+        if position is None:
+            logging.debug("* * * GPS not fixed")
+            return False
+
+        return self.weather.fetch(position[0], position[1], callback)
+
+    def apply_weather(self, conditions):
+        if conditions.get("valid"):
+            city = conditions.get("city")
+            self.temperature.name = city
+            self._set('/CustomName', city)
 
+            self.temperature.temperature = conditions.get("temperature")
+            self.temperature.humidity = conditions.get("humidity")
+            self.temperature.last_update = conditions.get("last_update")
+            return True
+        else:
+            logging.debug("* * * not valid weather.")
+            return False
+
+    def update_cpu(self, value):
+        if value is None:
+            if self.dbusservice['/Connected'] != 0:
+                logging.info("cpu temperature interface disconnected")
+                self._set('/Connected', 0)
+        else:
+            if self.dbusservice['/Connected'] != 1:
+                logging.info("cpu temperature interface connected")
+                self._set('/Connected', 1)
+            self.temperature.temperature = value
+
+    def set_connected(self, connected):
+        self.connected = connected
+        self._set('/Connected', 1 if connected else 0)
+        self._set('/Status', STATUS_OK if connected else STATUS_DISCONNECTED)
+
+    @contextmanager
+    def changes(self):
+        # paths set while handling one reading or tick are sent together when the outermost block exits
+        if self._batch is not None:
+            yield self._batch
+            return
+        with batched(self.dbusservice) as batch:
+            self._batch = batch
             try:
-                gps = self.config.get_gps()
-                latitude = VeDbusItemImport(self.dbus_conn, gps, '/Position/Latitude')
-                longitude = VeDbusItemImport(self.dbus_conn, gps, '/Position/Longitude')
-                logging.debug("* * * latitude: %s, longitude: %s" % (latitude.get_value(), longitude.get_value()))
-            except DBusException:
-                logging.exception("* * * GPS not connected")
-                return True
-
-            if latitude.get_value() is None or longitude.get_value() is None:
-                logging.debug("* * * GPS not fixed")
-                return True
-
-            if self.temperature.last_update is None or datetime.now() > self.temperature.last_update + timedelta(
-                    minutes=self.config.get_interval()):
-
-                if self.config.get_provider() == ProviderType.WUNDERGROUD.value:
-                    provider = WundergroundProvider(self.config.get_api_key(), self.config.get_units())
-                elif self.config.get_provider() == ProviderType.OPENWEATHER.value:
-                    provider = OpenweatherProvider(self.config.get_api_key(), self.config.get_units())
-                else:
-                    logging.debug("* * * not valid provider.")
-                    return True
-
-                provider.get_weather(latitude.get_value(), longitude.get_value())
-                conditions = provider.conditions
-                if conditions.get("valid"):
-                    city = conditions.get("city")
-                    self.temperature.name = city
-                    self.dbusservice['/CustomName'] = city
-
-                    self.temperature.temperature = conditions.get("temperature")
-                    self.temperature.humidity = conditions.get("humidity")
-                    self.temperature.last_update = conditions.get("last_update")
-                else:
-                    logging.debug("* * * not valid weather.")
-                    return True
-            else:
-                logging.debug("* * * Online Device: interval not reached, not updating")
+                yield batch
+            finally:
+                self._batch = None
 
-        if self.temperature.is_cpu:
-            if not os.path.exists(self.temperature.cpu_path):
-                if self.dbusservice['/Connected'] != 0:
-                   logging.info("cpu temperature interface disconnected")
-                   self.dbusservice['/Connected'] = 0
-            else:
-                if self.dbusservice['/Connected'] != 1:
-                   logging.info("cpu temperature interface connected")
-                   self.dbusservice['/Connected'] = 1
-                fd  = open(self.temperature.cpu_path,'r')
-                value = float(fd.read())
-                value = round(value / 1000.0, 1)
-                self.temperature.temperature = value
-
-        self.dbusservice['/Temperature'] = self.temperature.temperature
-        self.dbusservice['/Humidity'] = self.temperature.humidity
-
-
-        if self.config.get_aggregate():
-            temp = 0
-            humidity = 0
-            i = 0
-            for key, instance in instances.items():
-                logging.debug("* * * Instance %s type %d" % (instance.dbusservice.name, instance.temperature.device_type))
-                if instance.temperature.device_type == 4 and not instance.temperature.is_aggregate:
-                    temp = temp + instance.temperature.temperature
-                    humidity = humidity + instance.temperature.humidity
-                    i += 1
-                    logging.debug("* * * Total of outside instances %d" % i)
-
-            if 'aggregate_1' in instances:
-                aggregate_instance = instances['aggregate_1']
-                aggregate_instance.temperature.temperature = temp / i
-                aggregate_instance.temperature.humidity = humidity / i
-                aggregate_instance.dbusservice['/Temperature'] = aggregate_instance.temperature.temperature
-                aggregate_instance.dbusservice['/Humidity'] = aggregate_instance.temperature.humidity            
+    def _set(self, path, value):
+        if self._batch is not None:
+            self._batch[path] = value
+        else:
+            self.dbusservice[path] = value
+
+    def publish(self):
+        self._set('/Temperature', self.temperature.temperature)
+        self._set('/Humidity', self.temperature.humidity)
 
         index = self.dbusservice['/UpdateIndex'] + 1  # increment index
         if index > 255:  # maximum value of the index
             index = 0  # overflow from 255 to 0
-        self.dbusservice['/UpdateIndex'] = index
+        self._set('/UpdateIndex', index)
+
+    def record_history(self):
+        if self.history is None:
+            return
+        changes = self.history.add(time.time(), self.temperature.temperature, self.temperature.humidity)
+        for path, value in changes.items():
+            self._set(path, value)
+
+    def publish_changed(self, temperature_deadband, humidity_deadband):
+        if not exceeds_deadband(self.dbusservice['/Temperature'], self.temperature.temperature, temperature_deadband) \
+                and not exceeds_deadband(self.dbusservice['/Humidity'], self.temperature.humidity, humidity_deadband):
+            return False
+        self.publish()
         return True
 
     def _handlechangedvalue(self, path, value):
-        global instances
-        logging.debug("* * * change from outside %s to %s" % (path, value))
+        logging.debug("* * * change from outside %s to %s", path, value)
 
-        for key in instances:
-            instance = instances[key]
-            if instance.dbusservice.name == self.dbusservice.name:
-                logging.debug("* * * INSTANCE CHANGED %s - %s" % (key, self.dbusservice.name))
-                instance.temperature.device_type = value
-                instances[key] = self
-                break
+        if path == '/TemperatureType':
+            logging.debug("* * * INSTANCE CHANGED %s" % self.dbusservice.name)
+            self.temperature.device_type = value
 
         return True
 
-    @staticmethod
-    def is_process_running():
-        try:
-            tasklist_output = subprocess.check_output(['ps'], encoding='utf-8')
-            return "rtl_433" in tasklist_output
-        except subprocess.CalledProcessError:
-            return False
+    def close(self):
+        logging.info("* * * removing %s" % self.dbusservice.name)
+        # closing the private connection releases the service name and all its paths
+        self.bus.close()
+
+    def publish_rtl_433(self, supervisor):
+        with self.changes():
+            self._set('/Mgmt/Rtl433/Restarts', supervisor.restarts)
+            self._set('/Mgmt/Rtl433/Uptime', supervisor.uptime())
 
 
 def main():
+    global scheduler, ingest_queue, discovery, recorder, state
+    parser = argparse.ArgumentParser(description="Radio temperature sensors on dbus")
+    parser.add_argument("--replay", metavar="FILE",
+                        help="feed a recording through the pipeline instead of rtl_433 and the broker")
+    parser.add_argument("--speed", type=float, default=1.0, help="replay speed, 0 for as fast as possible")
+    args = parser.parse_args()
+
     config = AppConfig()
 
     # set logging level to include info level entries
@@ -198,6 +273,9 @@ def main():
     if config.get_debug():
         level = logging.DEBUG
     logging.basicConfig(level=level)
+    # keeps debug logging cheap when it is left on
+    for handler in logging.getLogger().handlers:
+        handler.addFilter(RateLimitFilter())
 
     logging.info(">>>>>>>>>>>>>>>> Radio Temperature Starting <<<<<<<<<<<<<<<<")
 
@@ -206,9 +284,6 @@ def main():
         sample_config_file = "%s/bin/rtl.conf" % (os.path.dirname(os.path.realpath(__file__)))
         shutil.copy(sample_config_file, config_file)
 
-    subprocess.Popen(['/data/RadioTemperature/bin/rtl_433', '-c', "/data/conf/rtl.conf"],
-                     stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
-
     thread.daemon = True
 
     from dbus.mainloop.glib import DBusGMainLoop
@@ -217,101 +292,364 @@ def main():
 
     devices = config.get_devices()
     online = config.get_online()
-    aggregate = config.get_aggregate()
     cpu = config.get_cpu()
 
-    if aggregate and not online:
-        aggregate = False
+    # the default outdoor aggregate needs the online device, configured groups do not
+    groups = config.get_aggregate_groups()
+    if not online and not config.has_aggregate_groups():
+        groups = []
 
     if online:
         provider = config.get_provider()
         device = Temperature("online", provider, 1, None, None, TemperatureType.OUTDOOR.value, True, 0, 0)
         devices.append(device)
 
-    if aggregate:
-        device = Temperature("Outdoor", "aggregate", 1, None, None, TemperatureType.OUTDOOR.value, False, 0, 0)
+    aggregate_groups = []
+    for i, (name, device_type, statistic) in enumerate(groups):
+        device = Temperature(name, "aggregate", i + 1, None, None, device_type, False, 0, 0)
         device.is_aggregate = True
         devices.append(device)
+        aggregate_groups.append(AggregateGroup(device_key(device.model, device.channel), name, device_type, statistic,
+                                               config.get_aggregate_timeout()))
 
-    if cpu:
-
-        # cerbogx path
-        cpu_found = True
-        cpu_path = '/sys/class/thermal/thermal_zone0/temp'
-        if not os.path.exists(cpu_path):
-            # check rpi path
-            cpu_path = '/sys/devices/virtual/thermal/thermal_zone0/temp'
-            if not os.path.exists(cpu_path):
-                cpu_found = False
+    thermal = None
+    if cpu or config.get_thermal_zones():
+        thermal = ThermalSource()
+        thermal.discover()
 
-        if cpu_found:
+        zone = thermal.first()
+        if cpu and zone is not None:
             device = Temperature("CPU", "cpu", 1, None, None, TemperatureType.GENERIC.value, False, 0, None)
             device.is_cpu = True
-            device.cpu_path = cpu_path
+            device.thermal_zone = zone.zone_id
             devices.append(device)
 
-    broker = Broker(config.get_mqtt_name(), config.get_mqtt_address(), config.get_mqtt_port())
-    broker.on_message(on_message)
-
+        if config.get_thermal_zones():
+            for zone in thermal.zones.values():
+                if cpu and zone is thermal.first():
+                    continue
+                device = Temperature(zone.name, "thermal", zone.zone_id, None, None, TemperatureType.GENERIC.value,
+                                     False, 0, None)
+                device.is_cpu = True
+                device.thermal_zone = zone.zone_id
+                devices.append(device)
+
+    scheduler = UpdateScheduler(config, AggregateEngine(aggregate_groups) if aggregate_groups else None)
+    scheduler.thermal = thermal
+    ingest_queue = IngestQueue(scheduler.apply_readings)
+
+    registry.configure(config)
     for device in devices:
         if not device.is_online and not device.is_aggregate and not device.is_cpu:
-            topic_category[device.topic] = device.model
-
-    broker.topic_category = topic_category
-
-    broker.connect_broker()
-
-    i = 0
+            registry.add(device)
+
+    ingestion = config.get_ingestion()
+    logging.info("* * * rtl_433 ingestion mode: %s" % ingestion)
+
+    on_line = on_rtl_433_line if ingestion == IngestionType.STDOUT.value else None
+    supervisors = []
+    for receiver in config.get_receivers() or (None,):
+        supervisors.append(Rtl433Supervisor(rtl_433_command(receiver),
+                                            backoff=config.get_rtl_backoff(),
+                                            backoff_max=config.get_rtl_backoff_max(),
+                                            crash_loop_limit=config.get_rtl_crash_loop_limit(),
+                                            crash_loop_cooldown=config.get_rtl_crash_loop_cooldown(),
+                                            on_line=on_line,
+                                            name='rtl_433 %s' % receiver.name if receiver else 'rtl_433'))
+    supervisor = supervisors[0] if len(supervisors) == 1 else Rtl433Pool(supervisors)
+    if not args.replay:
+        supervisor.start()
+
+    if config.get_record_path() and not args.replay:
+        recorder = TrafficRecorder(config.get_record_path(), config.get_record_max_size(),
+                                   config.get_record_compress())
+        scheduler.every(RECORD_FLUSH_INTERVAL, recorder.flush)
+        logging.info("* * * recording received messages to %s" % config.get_record_path())
+
+    broker = None
+    if ingestion == IngestionType.MQTT.value and not args.replay:
+        broker = Broker(config.get_mqtt_name(), config.get_mqtt_address(), config.get_mqtt_port(),
+                        qos=config.get_mqtt_qos(), subscription=config.get_mqtt_subscription(),
+                        reconnect_min=config.get_mqtt_reconnect_min(), reconnect_max=config.get_mqtt_reconnect_max())
+        broker.on_message(on_message)
+        broker.topic_category = registry.by_topic
+
+        broker.connect_broker()
+
+    # a replay runs against the live configuration, it leaves its state, discovered devices and metrics alone
+    if config.get_state() and not args.replay:
+        state = DeviceState(config.get_state_path(), config.get_state_max_age())
+        state.load()
+        scheduler.every(config.get_state_interval(), lambda: state.save(scheduler.services))
+
+    connection = 'rtl_433' if ingestion == IngestionType.STDOUT.value else 'MQTT'
+    if args.replay:
+        connection = 'Replay'
     for device in devices:
-        logging.debug("***** %s " % 'com.victronenergy.temperature.%s' % device.normalize_name())
-        logging.debug("***** %d " % device.device_type)
-        logging.debug("***** %s " % device.is_online)
-
-
-        service_name = 'com.victronenergy.temperature.%s' % device.normalize_name()
-        vac_output = RadioTemperatureService(
-            servicename=service_name,
-            deviceinstance=40 + i,
-            paths={
-                '/Temperature': {'initial': 0},
-                '/Humidity': {'initial': None},
-                '/Pressure': {'initial': None},
-                '/Status': {'initial': 0},
-                '/TemperatureType': {'initial': device.device_type},
-                '/CustomName': {'initial': device.normalize_name()},
-                '/UpdateIndex': {'initial': 0},
-            },
-            config=config,
-            device=device
-        )
-        instances[f'{device.model}_{device.channel}'] = vac_output
-        i = i + 1
+        create_service(config, device, connection)
+
+    if config.get_discovery():
+        def register(key, info, data):
+            name = info["model"] if info["channel"] is None else f'{info["model"]} {info["channel"]}'
+            device = Temperature(name, info["model"], info["channel"], info["topic"],
+                                 config.get_discovery_temperature_field(), config.get_discovery_device_type(),
+                                 False, 0, None)
+            entry = registry.add(device)
+            create_service(config, device, connection)
+            if data is not None:
+                ingest_queue.put(entry.key, entry.extract(data))
+
+        def unregister(key):
+            registry.remove(key)
+            remove_service(key)
+
+        discovery = DeviceDiscovery(config.get_discovery_path(), config.get_discovery_max_devices(),
+                                    config.get_discovery_temperature_field(), register, unregister)
+        if not args.replay:
+            discovery.load()
+            scheduler.every(DISCOVERY_SAVE_INTERVAL, discovery.save)
+        ingest_queue.handler = lambda readings: apply_discovered_readings(discovery, readings)
+        if ingestion == IngestionType.MQTT.value and not config.get_mqtt_subscription():
+            logging.warning("Discovery needs a wildcard subscription in [MQTTBroker] to see new devices")
+
+    def publish_rtl_433(sup):
+        for service in scheduler.services.values():
+            service.publish_rtl_433(sup)
+
+    metrics.gauge("rtl433_restarts", "rtl_433 restarts", lambda: supervisor.restarts)
+    metrics.gauge("rtl433_uptime_seconds", "rtl_433 uptime", supervisor.uptime)
+    metrics.gauge("devices", "Active temperature services", lambda: len(scheduler.services))
+    management = ManagementService(config, connection)
+    scheduler.every(STATS_INTERVAL, management.publish)
+    if config.get_metrics_textfile() and not args.replay:
+        scheduler.every(config.get_metrics_interval(),
+                        lambda: metrics.write_textfile(config.get_metrics_textfile()))
+
+    if not args.replay:
+        watcher = ConfigWatcher(config, lambda old, new: reload_config(old, new, connection, broker))
+        scheduler.every(CONFIG_CHECK_INTERVAL, watcher.check)
+
+    supervisor.add_listener(publish_rtl_433)
+    scheduler.every(MGMT_INTERVAL, lambda: publish_rtl_433(supervisor))
+    scheduler.start()
 
     logging.info('Connected to dbus, and switching over to GLib.MainLoop() (= event based)')
     mainloop = GLib.MainLoop()
+
+    def shutdown():
+        logging.info(">>>>>>>>>>>>>>>> Radio Temperature Stopping <<<<<<<<<<<<<<<<")
+        try:
+            supervisor.stop()
+            if discovery is not None and not args.replay:
+                discovery.save()
+            if recorder is not None:
+                recorder.close()
+            if state is not None:
+                state.save(scheduler.services)
+        finally:
+            mainloop.quit()
+        return False
+
+    GLib.unix_signal_add(GLib.PRIORITY_HIGH, signal.SIGTERM, shutdown)
+    if args.replay:
+        def replay_recording():
+            try:
+                replay(args.replay, on_message, on_rtl_433_line, speed=args.speed)
+            except (OSError, ValueError):
+                logging.exception("Error replaying %s" % args.replay)
+            # let the main loop publish what is still queued
+            GLib.timeout_add_seconds(1, shutdown)
+
+        threading.Thread(target=replay_recording, daemon=True).start()
     mainloop.run()
 
 
-def on_message(client, userdata, msg):
-    try:
-        logging.debug('* * * Incoming message from: ' + msg.topic)
-        if msg.topic in topic_category:
-            jsonpayload = json.loads(msg.payload)
+class ManagementService:
+    # process wide statistics on a service of its own
+    def __init__(self, config, connection):
+        self.dbusservice = VeDbusService(MGMT_SERVICE, bus=dbus_connection(), register=False)
+        self.dbusservice.add_path('/Mgmt/ProcessName', __file__)
+        self.dbusservice.add_path('/Mgmt/ProcessVersion', config.get_version())
+        self.dbusservice.add_path('/Mgmt/Connection', connection)
+        for path in STATS_PATHS:
+            self.dbusservice.add_path(path, 0)
+        self.dbusservice.register()
+
+    def publish(self):
+        values = {
+            '/Mgmt/Stats/Messages/Received': messages_received.value,
+            '/Mgmt/Stats/Messages/Parsed': messages_parsed.value,
+            '/Mgmt/Stats/Messages/Dropped': messages_dropped.value,
+            '/Mgmt/Stats/Messages/Filtered': messages_filtered.value,
+            '/Mgmt/Stats/Messages/ParseErrors': parse_errors.value,
+            '/Mgmt/Stats/Update/Count': update_duration.count,
+            '/Mgmt/Stats/Update/AverageMs': round(update_duration.average() * 1000, 3),
+            '/Mgmt/Stats/Provider/Fetches': provider_latency.count,
+            '/Mgmt/Stats/Provider/AverageMs': round(provider_latency.average() * 1000),
+            '/Mgmt/Stats/Provider/Failures': provider_failures.value,
+            '/Mgmt/Stats/Mqtt/Reconnects': mqtt_reconnects.value,
+        }
+        with batched(self.dbusservice) as batch:
+            for path, value in values.items():
+                batch[path] = value
+
+
+def rtl_433_command(receiver=None):
+    if receiver is None:
+        return [RTL_433, '-c', RTL_433_CONFIG_FILE]
+    # frequencies and protocols are added to those of the conf file
+    command = [RTL_433, '-c', receiver.conf]
+    if receiver.device:
+        command += ['-d', receiver.device]
+    if receiver.frequency:
+        command += ['-f', receiver.frequency]
+    for protocol in receiver.protocols:
+        command += ['-R', protocol]
+    return command
+
+
+def create_service(config, device, connection):
+    logging.debug("***** %s " % 'com.victronenergy.temperature.%s' % device.normalize_name())
+    logging.debug("***** %d " % device.device_type)
+    logging.debug("***** %s " % device.is_online)
+
+    service_name = 'com.victronenergy.temperature.%s' % device.normalize_name()
+    configured_type = device.device_type
+    restored = state.restore(device_key(device.model, device.channel), device) if state is not None else None
+    vac_output = RadioTemperatureService(
+        servicename=service_name,
+        deviceinstance=allocate_device_instance(),
+        paths={
+            '/Temperature': {'initial': device.temperature if restored else 0},
+            '/Humidity': {'initial': device.humidity if restored else None},
+            '/Pressure': {'initial': device.pressure if restored else None},
+            '/Status': {'initial': 0},
+            '/TemperatureType': {'initial': device.device_type},
+            '/CustomName': {'initial': device.normalize_name()},
+            '/UpdateIndex': {'initial': 0},
+        },
+        connection=connection,
+        config=config,
+        device=device
+    )
+    vac_output.configured_type = configured_type
+    if restored:
+        # the restored values are shown as stale until fresh data arrives
+        with vac_output.changes() as changes:
+            if device.is_online and restored.get("name"):
+                device.name = restored["name"]
+                changes['/CustomName'] = device.name
+            vac_output.set_connected(False)
+    scheduler.add(vac_output.key, vac_output)
+    return vac_output
+
+
+def reload_config(old, new, connection, broker):
+    old_devices = {device.key: device for device in old.snapshot.devices}
+    added, removed, changed = diff_devices(old.snapshot, new.snapshot)
+
+    for device in removed:
+        logging.info("* * * device %s removed from configuration" % device.key)
+        remove_device(device.key, broker)
+    for device in changed:
+        service = scheduler.services.get(device.key)
+        if service is not None and replace(old_devices[device.key], device_type=device.device_type) == device:
+            logging.info("* * * device %s type changed to %d" % (device.key, device.device_type))
+            service.temperature.device_type = device.device_type
+            service.configured_type = device.device_type
+            service.dbusservice['/TemperatureType'] = device.device_type
+            continue
+        logging.info("* * * device %s reconfigured" % device.key)
+        remove_device(device.key, broker)
+        added.append(device)
+    registry.configure(new)
+    for device in added:
+        logging.info("* * * device %s added to configuration" % device.key)
+        temperature = create_device(device)
+        registry.add(temperature)
+        create_service(new, temperature, connection)
+        if broker is not None and temperature.topic:
+            broker.subscribe(temperature.topic)
+
+    scheduler.configure(new)
+    logging.getLogger().setLevel(logging.DEBUG if new.get_debug() else logging.INFO)
+    restart = [name for name in old.snapshot.changed_fields(new.snapshot) if name not in RELOADABLE]
+    if restart:
+        logging.info("* * * restart the service to apply: %s" % ", ".join(restart))
+
+
+def remove_device(key, broker):
+    entry = registry.remove(key)
+    remove_service(key)
+    if broker is not None and entry is not None and entry.device.topic:
+        broker.unsubscribe(entry.device.topic)
+
+
+def remove_service(key):
+    service = scheduler.remove(key)
+    if service is not None:
+        device_instances.discard(service.deviceinstance)
+        service.close()
+
+
+def allocate_device_instance():
+    instance = FIRST_DEVICE_INSTANCE
+    while instance in device_instances:
+        instance += 1
+    device_instances.add(instance)
+    return instance
+
+
+def apply_discovered_readings(discovery, readings):
+    for key in readings:
+        discovery.touch(key)
+    scheduler.apply_readings(readings)
 
-            instance = instances[f'{jsonpayload["model"]}_{jsonpayload["channel"]}']
-            device = instance.temperature
 
-            device.temperature = jsonpayload[device.temperature_json_field]
-            device.humidity = jsonpayload['humidity']
-            if 'pressure_hPa' in jsonpayload:
-                device.pressure = jsonpayload['pressure_hPa']
+def on_message(client, userdata, msg):
+    messages_received.inc()
+    if recorder is not None:
+        recorder.record(msg.topic, msg.payload)
+    try:
+        logging.debug('* * * Incoming message from: %s', msg.topic)
+        key, reading = registry.decode_topic(msg.topic, msg.payload)
+        if reading is not None:
+            messages_parsed.inc()
+            ingest_queue.put(key, reading)
+        elif key is not None:
+            messages_filtered.inc()
         else:
-            logging.debug("Topic not in configurd topics. This shouldn't be happen")
+            messages_dropped.inc()
+            if discovery is not None:
+                discovery.observe(msg.payload, msg.topic)
+            else:
+                logging.debug("* * * Topic not configured: %s", msg.topic)
 
     except Exception as e:
-        logging.exception("Error in handling of received message payload: " + msg.payload)
+        parse_errors.inc()
+        logging.exception("Error in handling of received message payload: " + str(msg.payload))
         logging.exception(e)
 
 
+def on_rtl_433_line(line):
+    messages_received.inc()
+    if recorder is not None:
+        recorder.record(None, line)
+    try:
+        key, reading = registry.decode_line(line)
+        if reading is not None:
+            messages_parsed.inc()
+            ingest_queue.put(key, reading)
+        elif key is not None:
+            messages_filtered.inc()
+        else:
+            messages_dropped.inc()
+            if discovery is not None:
+                discovery.observe(line)
+    except Exception:
+        parse_errors.inc()
+        logging.exception("Error in handling of rtl_433 output: " + str(line))
+
+
 if __name__ == "__main__":
     main()
@@ -0,0 +1,115 @@
+import bisect
+import logging
+from enum import Enum
+
+
+class Statistic(Enum):
+    MEAN = "mean"
+    MEDIAN = "median"
+    MIN = "min"
+    MAX = "max"
+
+
+class RunningStat:
+    # running sum and sorted values, every add/remove keeps all statistics ready
+    def __init__(self):
+        self.total = 0.0
+        self.values = []
+
+    def add(self, value):
+        self.total += value
+        bisect.insort(self.values, value)
+
+    def remove(self, value):
+        self.total -= value
+        i = bisect.bisect_left(self.values, value)
+        if i < len(self.values) and self.values[i] == value:
+            del self.values[i]
+
+    def result(self, statistic):
+        n = len(self.values)
+        if n == 0:
+            return None
+        if statistic == Statistic.MEAN:
+            return self.total / n
+        if statistic == Statistic.MIN:
+            return self.values[0]
+        if statistic == Statistic.MAX:
+            return self.values[-1]
+        if n % 2:
+            return self.values[n // 2]
+        return (self.values[n // 2 - 1] + self.values[n // 2]) / 2
+
+
+class AggregateGroup:
+    def __init__(self, key, name, device_type, statistic, timeout):
+        self.key = key
+        self.name = name
+        self.device_type = device_type
+        self.statistic = statistic
+        self.timeout = timeout
+        # member key -> (temperature, humidity, last seen)
+        self.members = {}
+        self.temperature = RunningStat()
+        self.humidity = RunningStat()
+
+    def update(self, member, temperature, humidity, now):
+        self.remove(member)
+        if temperature is not None:
+            self.temperature.add(temperature)
+        if humidity is not None:
+            self.humidity.add(humidity)
+        self.members[member] = (temperature, humidity, now)
+
+    def remove(self, member):
+        old = self.members.pop(member, None)
+        if old is None:
+            return False
+        if old[0] is not None:
+            self.temperature.remove(old[0])
+        if old[1] is not None:
+            self.humidity.remove(old[1])
+        return True
+
+    def expire(self, now):
+        stale = [member for member, value in self.members.items() if now - value[2] > self.timeout]
+        for member in stale:
+            logging.debug("* * * %s: %s expired", self.name, member)
+            self.remove(member)
+        return len(stale) > 0
+
+    def values(self):
+        return self.temperature.result(self.statistic), self.humidity.result(self.statistic)
+
+
+class AggregateEngine:
+    def __init__(self, groups):
+        self.groups = groups
+        self._by_type = {}
+        for group in groups:
+            self._by_type.setdefault(group.device_type, []).append(group)
+        # member key -> groups it currently contributes to
+        self._membership = {}
+
+    def update(self, member, device, now):
+        changed = set()
+        # the cpu and thermal zones are never averaged with the sensors of their type
+        groups = [] if device.is_aggregate or device.is_cpu else self._by_type.get(device.device_type, [])
+        for group in self._membership.get(member, []):
+            if group not in groups and group.remove(member):
+                changed.add(group)
+        for group in groups:
+            group.update(member, device.temperature, device.humidity, now)
+            changed.add(group)
+        self._membership[member] = groups
+        return changed
+
+    def remove(self, member):
+        changed = set()
+        for group in self._membership.pop(member, []):
+            if group.remove(member):
+                changed.add(group)
+        return changed
+
+    def expire(self, now):
+        return set(group for group in self.groups if group.expire(now))
@@ -2,99 +2,559 @@ import configparser
 import logging
 import os
 import shutil
+from dataclasses import dataclass, fields
+from enum import Enum
+from functools import lru_cache
+from typing import Optional, Tuple
 
-from temperature import Temperature
+from aggregate import Statistic
+from registry import device_key
+from temperature import Temperature, TemperatureType
+
+CONFIG_FILE = "%s/../conf/radio_temperature_config.ini" % (os.path.dirname(os.path.realpath(__file__)))
+RTL_433_CONFIG_FILE = "/data/conf/rtl.conf"
+
+
+class IngestionType(Enum):
+    MQTT = "mqtt"
+    STDOUT = "stdout"
+
+
+@dataclass(frozen=True)
+class DeviceConfig:
+    name: str
+    model: str
+    channel: str
+    topic: str
+    temperature_json_field: str
+    device_type: int
+    smoothing: Optional[str] = None
+
+    @property
+    def key(self):
+        return device_key(self.model, self.channel)
+
+
+@dataclass(frozen=True)
+class ReceiverConfig:
+    name: str
+    device: Optional[str]
+    frequency: Optional[str]
+    protocols: Tuple[str, ...]
+    conf: str
+
+
+@dataclass(frozen=True)
+class ConfigSnapshot:
+    debug: bool
+    gps: str
+    aggregate: bool
+    aggregate_timeout: int
+    has_aggregate_groups: bool
+    aggregate_groups: Tuple[Tuple[str, int, Statistic], ...]
+    history: bool
+    history_tiers: Tuple[Tuple[int, int], ...]
+    cpu: bool
+    thermal_zones: bool
+    tick: int
+    cpu_interval: int
+    temperature_deadband: float
+    humidity_deadband: float
+    rtl_backoff: int
+    rtl_backoff_max: int
+    rtl_crash_loop_limit: int
+    rtl_crash_loop_cooldown: int
+    receivers: Tuple[ReceiverConfig, ...]
+    ingestion: str
+    mqtt_address: Optional[str]
+    mqtt_port: int
+    mqtt_name: str
+    mqtt_qos: int
+    mqtt_subscription: Optional[str]
+    mqtt_reconnect_min: int
+    mqtt_reconnect_max: int
+    online: bool
+    provider: str
+    api_key: str
+    providers: Tuple[Tuple[str, str, int], ...]
+    hedge_delay: float
+    failure_threshold: int
+    breaker_cooldown: int
+    interval: int
+    connect_timeout: float
+    read_timeout: float
+    cache_precision: int
+    units: str
+    discovery: bool
+    discovery_max_devices: int
+    discovery_device_type: int
+    discovery_temperature_field: str
+    metrics_textfile: Optional[str]
+    metrics_interval: int
+    record_path: Optional[str]
+    record_max_size: int
+    record_compress: bool
+    state: bool
+    state_interval: int
+    state_max_age: int
+    duplicate_window: float
+    max_jump: float
+    smoothing: str
+    median_size: int
+    ewma_alpha: float
+    kalman_process_noise: float
+    kalman_measurement_noise: float
+    stale_timeout: int
+    stale_model_timeouts: Tuple[Tuple[str, int], ...]
+    devices: Tuple[DeviceConfig, ...]
+
+    def changed_fields(self, other):
+        return [field.name for field in fields(self) if getattr(self, field.name) != getattr(other, field.name)]
 
 
 class AppConfig:
+    # the configuration file is parsed and validated once, getters read the snapshot
     def __init__(self):
         self.config = configparser.ConfigParser()
-        config_file = "%s/../conf/radio_temperature_config.ini" % (os.path.dirname(os.path.realpath(__file__)))
-        if not os.path.exists(config_file):
+        if not os.path.exists(CONFIG_FILE):
             sample_config_file = "%s/config.sample.ini" % (os.path.dirname(os.path.realpath(__file__)))
-            shutil.copy(sample_config_file, config_file)
-        self.config.read("%s/../conf/radio_temperature_config.ini" % (os.path.dirname(os.path.realpath(__file__))))
+            shutil.copy(sample_config_file, CONFIG_FILE)
+        self.config.read(CONFIG_FILE)
+        self.snapshot = self._parse()
+
+    def _bool(self, section, key, fallback):
+        return self.config.get(section, key, fallback=fallback) == "true"
+
+    def _number(self, kind, section, key, fallback):
+        val = self.config.get(section, key, fallback=None)
+        if val is None:
+            return fallback
+        try:
+            return kind(val)
+        except ValueError:
+            logging.error("Invalid value %s for %s in [%s], using %s" % (val, key, section, fallback))
+            return fallback
+
+    def _int(self, section, key, fallback):
+        return self._number(int, section, key, fallback)
+
+    def _float(self, section, key, fallback):
+        return self._number(float, section, key, fallback)
+
+    def _parse(self):
+        has_aggregate_groups = self.config.has_section('Aggregates') and len(self.config['Aggregates']) > 0
+
+        ingestion = self.config.get("Rtl433", "ingestion", fallback=IngestionType.MQTT.value)
+        if ingestion not in (IngestionType.MQTT.value, IngestionType.STDOUT.value):
+            logging.error("Unknown rtl_433 ingestion %s, using mqtt" % ingestion)
+            ingestion = IngestionType.MQTT.value
+
+        address = self.config.get('MQTTBroker', 'address', fallback=None)
+        if address is None:
+            logging.error("No MQTT Broker set in config.ini")
+
+        providers = self._parse_providers()
+
+        units = self.config.get('Online', 'units', fallback="metric")
+        if units not in ("metric", "imperial"):
+            logging.error("Unknown units %s, using metric" % units)
+            units = "metric"
+
+        return ConfigSnapshot(
+            debug=self._bool("Setup", "debug", "false"),
+            gps=self.config.get("Setup", "gps", fallback="com.victronenergy.gps.ve_ttyACM0"),
+            aggregate=self._bool("Setup", "aggregate", "false"),
+            aggregate_timeout=self._int("Setup", "aggregateTimeout", 3600),
+            has_aggregate_groups=has_aggregate_groups,
+            aggregate_groups=self._parse_aggregate_groups(has_aggregate_groups),
+            history=self._bool("History", "enabled", "true"),
+            history_tiers=self._parse_history_tiers(),
+            cpu=self._bool("Setup", "cpu", "true"),
+            thermal_zones=self._bool("Setup", "thermalZones", "false"),
+            tick=max(1, self._int("Setup", "tick", 1)),
+            cpu_interval=self._int("Setup", "cpuInterval", 5),
+            temperature_deadband=self._float("Setup", "temperatureDeadband", 0.1),
+            humidity_deadband=self._float("Setup", "humidityDeadband", 1),
+            rtl_backoff=max(1, self._int("Rtl433", "restartBackoff", 1)),
+            rtl_backoff_max=self._int("Rtl433", "restartBackoffMax", 300),
+            rtl_crash_loop_limit=self._int("Rtl433", "crashLoopLimit", 5),
+            rtl_crash_loop_cooldown=self._int("Rtl433", "crashLoopCooldown", 600),
+            receivers=self._parse_receivers(),
+            ingestion=ingestion,
+            mqtt_address=address,
+            mqtt_port=self._int('MQTTBroker', 'port', 1883),
+            mqtt_name=self.config.get('MQTTBroker', 'name', fallback='MQTT_to_Inverter'),
+            mqtt_qos=self._int('MQTTBroker', 'qos', 0),
+            mqtt_subscription=self.config.get('MQTTBroker', 'subscription', fallback=None) or None,
+            mqtt_reconnect_min=self._int('MQTTBroker', 'reconnectMin', 1),
+            mqtt_reconnect_max=self._int('MQTTBroker', 'reconnectMax', 120),
+            online=self._bool('Online', 'addDevice', "false"),
+            provider=providers[0][0],
+            api_key=self.config.get('Online', 'apiKey', fallback=False),
+            providers=providers,
+            hedge_delay=self._float('Online', 'hedgeDelay', 3),
+            failure_threshold=max(1, self._int('Online', 'failureThreshold', 3)),
+            breaker_cooldown=self._int('Online', 'breakerCooldown', 600),
+            interval=self._int('Online', 'interval', 10),
+            connect_timeout=self._float('Online', 'connectTimeout', 5),
+            read_timeout=self._float('Online', 'readTimeout', 15),
+            cache_precision=self._int('Online', 'cachePrecision', 5),
+            units=units,
+            discovery=self._bool('Discovery', 'enabled', "false"),
+            discovery_max_devices=self._int('Discovery', 'maxDevices', 10),
+            discovery_device_type=self._int('Discovery', 'type', TemperatureType.GENERIC.value),
+            discovery_temperature_field=self.config.get('Discovery', 'temperatureField', fallback="temperature_C"),
+            metrics_textfile=self.config.get('Metrics', 'textfile', fallback=None) or None,
+            metrics_interval=max(1, self._int('Metrics', 'interval', 60)),
+            record_path=self.config.get('Record', 'path', fallback=None) or None,
+            record_max_size=max(1, self._int('Record', 'maxSize', 10240)) * 1024,
+            record_compress=self._bool('Record', 'compress', 'true'),
+            state=self._bool('State', 'enabled', 'true'),
+            state_interval=max(1, self._int('State', 'interval', 60)),
+            state_max_age=self._int('State', 'maxAge', 86400),
+            duplicate_window=self._float('Filters', 'duplicateWindow', 2),
+            max_jump=self._float('Filters', 'maxJump', 10),
+            smoothing=self.config.get('Filters', 'smoothing', fallback='none'),
+            median_size=max(1, self._int('Filters', 'medianSize', 5)),
+            ewma_alpha=min(1.0, max(0.01, self._float('Filters', 'ewmaAlpha', 0.3))),
+            kalman_process_noise=self._float('Filters', 'kalmanProcessNoise', 0.01),
+            kalman_measurement_noise=self._float('Filters', 'kalmanMeasurementNoise', 0.25),
+            stale_timeout=self._int('Staleness', 'timeout', 900),
+            stale_model_timeouts=self._parse_stale_model_timeouts(),
+            devices=self._parse_devices(),
+        )
+
+    def _parse_aggregate_groups(self, has_aggregate_groups):
+        if not self._bool("Setup", "aggregate", "false"):
+            return ()
+        if not has_aggregate_groups:
+            return (("Outdoor", TemperatureType.OUTDOOR.value, Statistic.MEAN),)
+
+        groups = []
+        for key in self.config['Aggregates']:
+            group_info = self.config['Aggregates'][key].split(',')
+            try:
+                statistic = Statistic(group_info[1].strip()) if len(group_info) > 1 else Statistic.MEAN
+            except ValueError:
+                logging.error("Unknown statistic for aggregate %s, using mean" % key)
+                statistic = Statistic.MEAN
+            try:
+                groups.append((key, int(group_info[0]), statistic))
+            except ValueError:
+                logging.error("Invalid type for aggregate %s, skipped" % key)
+        return tuple(groups)
+
+    def _parse_history_tiers(self):
+        tiers = []
+        for tier in self.config.get("History", "tiers", fallback="60:1440,900:2880").split(','):
+            try:
+                resolution, size = tier.split(':')
+                tiers.append((int(resolution), int(size)))
+            except ValueError:
+                logging.error("Invalid history tier %s, skipped" % tier)
+        return tuple(tiers)
+
+    def _parse_providers(self):
+        # ordered list of providers, each with its own api key and daily request limit
+        providers = []
+        api_key = self.config.get('Online', 'apiKey', fallback=False)
+        for name in self.config.get('Online', 'provider', fallback="wunderground").split(','):
+            name = name.strip()
+            if name:
+                providers.append((name, self.config.get('Online', name + 'ApiKey', fallback=None) or api_key,
+                                  self._int('Online', name + 'DailyLimit', 0)))
+        return tuple(providers) or (("wunderground", api_key, 0),)
+
+    def _parse_receivers(self):
+        receivers = []
+        if not self.config.has_section('Receivers'):
+            return ()
+        for name in self.config['Receivers']:
+            info = [field.strip() for field in self.config['Receivers'][name].split(',')] + [''] * 4
+            receivers.append(ReceiverConfig(name, info[0] or None, info[1] or None, tuple(info[2].split()),
+                                            info[3] or RTL_433_CONFIG_FILE))
+        return tuple(receivers)
+
+    def _parse_stale_model_timeouts(self):
+        timeouts = []
+        if not self.config.has_section('Staleness'):
+            return ()
+        for model, value in self.config['Staleness'].items():
+            if model == 'timeout':
+                continue
+            try:
+                timeouts.append((model, int(value)))
+            except ValueError:
+                logging.error("Invalid timeout %s for model %s, skipped" % (value, model))
+        return tuple(timeouts)
+
+    def _parse_devices(self):
+        devices = []
+        if not self.config.has_section('Devices'):
+            return ()
+        for key in self.config['Devices']:
+            logging.debug("* * * get_devices: %s " % key)
+            device_info = [info.strip() for info in self.config['Devices'][key].split(',')]
+            try:
+                devices.append(DeviceConfig(key, device_info[0], device_info[1], device_info[2], device_info[3],
+                                            int(device_info[4]), device_info[5] if len(device_info) > 5 else None))
+            except (IndexError, ValueError):
+                logging.error("Invalid device %s, skipped" % key)
+        return tuple(devices)
 
     def get_debug(self):
-        val = self.config.get("Setup", "debug", fallback=False)
-        if val == "true":
-            return True
-        else:
-            return False
+        return self.snapshot.debug
 
     def get_gps(self):
-        return self.config.get("Setup", "gps", fallback="com.victronenergy.gps.ve_ttyACM0")
+        return self.snapshot.gps
 
     def get_aggregate(self):
-        val = self.config.get("Setup", "aggregate", fallback=False)
-        if val == "true":
-            return True
-        else:
-            return False
+        return self.snapshot.aggregate
+
+    def get_aggregate_timeout(self):
+        return self.snapshot.aggregate_timeout
+
+    def has_aggregate_groups(self):
+        return self.snapshot.has_aggregate_groups
+
+    def get_aggregate_groups(self):
+        return self.snapshot.aggregate_groups
+
+    def get_history(self):
+        return self.snapshot.history
+
+    def get_history_tiers(self):
+        return self.snapshot.history_tiers
 
     def get_cpu(self):
-        val = self.config.get("Setup", "cpu", fallback="true")
-        if val == "true":
-            return True
-        else:
-            return False
+        return self.snapshot.cpu
+
+    def get_thermal_zones(self):
+        return self.snapshot.thermal_zones
+
+    def get_tick(self):
+        return self.snapshot.tick
+
+    def get_cpu_interval(self):
+        return self.snapshot.cpu_interval
+
+    def get_temperature_deadband(self):
+        return self.snapshot.temperature_deadband
+
+    def get_humidity_deadband(self):
+        return self.snapshot.humidity_deadband
+
+    def get_rtl_backoff(self):
+        return self.snapshot.rtl_backoff
+
+    def get_rtl_backoff_max(self):
+        return self.snapshot.rtl_backoff_max
+
+    def get_rtl_crash_loop_limit(self):
+        return self.snapshot.rtl_crash_loop_limit
+
+    def get_rtl_crash_loop_cooldown(self):
+        return self.snapshot.rtl_crash_loop_cooldown
+
+    def get_receivers(self):
+        return self.snapshot.receivers
+
+    def get_ingestion(self):
+        return self.snapshot.ingestion
 
     def get_mqtt_address(self):
-        address = self.config.get('MQTTBroker', 'address', fallback=None)
-        if address is None:
-            logging.error("No MQTT Broker set in config.ini")
-            return address
-        else:
-            return address
+        return self.snapshot.mqtt_address
 
     def get_mqtt_port(self):
-        port = self.config.get('MQTTBroker', 'port', fallback=None)
-        if port is not None:
-            return int(port)
-        else:
-            return 1883
+        return self.snapshot.mqtt_port
 
     def get_mqtt_name(self):
-        return self.config.get('MQTTBroker', 'name', fallback='MQTT_to_Inverter')
+        return self.snapshot.mqtt_name
+
+    def get_mqtt_qos(self):
+        return self.snapshot.mqtt_qos
+
+    def get_mqtt_subscription(self):
+        return self.snapshot.mqtt_subscription
+
+    def get_mqtt_reconnect_min(self):
+        return self.snapshot.mqtt_reconnect_min
+
+    def get_mqtt_reconnect_max(self):
+        return self.snapshot.mqtt_reconnect_max
 
     def get_online(self):
-        val = self.config.get('Online', 'addDevice', fallback=False)
-        if val == "true":
-            return True
-        else:
-            return False
+        return self.snapshot.online
 
     def get_provider(self):
-        return self.config.get('Online', 'provider', fallback="wunderground")
+        return self.snapshot.provider
 
     def get_api_key(self):
-        return self.config.get('Online', 'apiKey', fallback=False)
+        return self.snapshot.api_key
+
+    def get_providers(self):
+        return self.snapshot.providers
+
+    def get_hedge_delay(self):
+        return self.snapshot.hedge_delay
+
+    def get_failure_threshold(self):
+        return self.snapshot.failure_threshold
+
+    def get_breaker_cooldown(self):
+        return self.snapshot.breaker_cooldown
 
     def get_interval(self):
-        return int(self.config.get('Online', 'interval', fallback=10))
+        return self.snapshot.interval
+
+    def get_connect_timeout(self):
+        return self.snapshot.connect_timeout
+
+    def get_read_timeout(self):
+        return self.snapshot.read_timeout
+
+    def get_cache_precision(self):
+        return self.snapshot.cache_precision
+
+    @staticmethod
+    def get_weather_cache_path():
+        return "%s/../conf/radio_temperature_weather.json" % (os.path.dirname(os.path.realpath(__file__)))
 
     def get_units(self):
-        units = self.config.get('Online', 'units', fallback="metric")
-        if units != "metric" or units != "imperial":
-            units = "metric"
-        return units
+        return self.snapshot.units
 
-    def get_devices(self):
-        devices = []
-        for key in self.config['Devices']:
-            logging.debug("* * * get_devices: %s " % key)
-            device_info = self.config['Devices'][key].split(',')
-            devices.append(Temperature(key, device_info[0], device_info[1], device_info[2], device_info[3], int(device_info[4]), False,0, 0 ))
-        return devices
+    def get_discovery(self):
+        return self.snapshot.discovery
+
+    def get_discovery_max_devices(self):
+        return self.snapshot.discovery_max_devices
+
+    def get_discovery_device_type(self):
+        return self.snapshot.discovery_device_type
+
+    def get_discovery_temperature_field(self):
+        return self.snapshot.discovery_temperature_field
+
+    @staticmethod
+    def get_discovery_path():
+        return "%s/../conf/radio_temperature_discovered.json" % (os.path.dirname(os.path.realpath(__file__)))
+
+    def get_metrics_textfile(self):
+        return self.snapshot.metrics_textfile
+
+    def get_metrics_interval(self):
+        return self.snapshot.metrics_interval
 
+    def get_record_path(self):
+        return self.snapshot.record_path
+
+    def get_record_max_size(self):
+        return self.snapshot.record_max_size
+
+    def get_record_compress(self):
+        return self.snapshot.record_compress
+
+    def get_state(self):
+        return self.snapshot.state
+
+    def get_state_interval(self):
+        return self.snapshot.state_interval
+
+    def get_state_max_age(self):
+        return self.snapshot.state_max_age
+
+    @staticmethod
+    def get_state_path():
+        return "%s/../conf/radio_temperature_state.json" % (os.path.dirname(os.path.realpath(__file__)))
+
+    def get_duplicate_window(self):
+        return self.snapshot.duplicate_window
+
+    def get_max_jump(self):
+        return self.snapshot.max_jump
+
+    def get_smoothing(self):
+        return self.snapshot.smoothing
+
+    def get_median_size(self):
+        return self.snapshot.median_size
+
+    def get_ewma_alpha(self):
+        return self.snapshot.ewma_alpha
+
+    def get_kalman_process_noise(self):
+        return self.snapshot.kalman_process_noise
+
+    def get_kalman_measurement_noise(self):
+        return self.snapshot.kalman_measurement_noise
+
+    def get_stale_timeout(self, model):
+        # option names are lower case in configparser
+        model = str(model).lower()
+        for name, timeout in self.snapshot.stale_model_timeouts:
+            if name == model:
+                return timeout
+        return self.snapshot.stale_timeout
+
+    def get_devices(self):
+        return [create_device(device) for device in self.snapshot.devices]
 
     def write_to_config(self, value, path, key):
         logging.debug("Writing config file %s %s " % (path, key))
         self.config[path][key] = str(value)
-        with open("%s/../conf/radio_temperature_config.ini" % (os.path.dirname(os.path.realpath(__file__))), 'w') as configfile:
+        with open(CONFIG_FILE, 'w') as configfile:
             self.config.write(configfile)
+        self.snapshot = self._parse()
 
     @staticmethod
+    @lru_cache(maxsize=None)
     def get_version():
         with open("%s/version" % (os.path.dirname(os.path.realpath(__file__))), 'r') as file:
             return file.read()
+
+
+def create_device(device):
+    temperature = Temperature(device.name, device.model, device.channel, device.topic, device.temperature_json_field,
+                              device.device_type, False, 0, 0)
+    temperature.smoothing = device.smoothing
+    return temperature
+
+
+def diff_devices(old, new):
+    # returns the device configs added, removed and changed between two snapshots
+    old_devices = {device.key: device for device in old.devices}
+    new_devices = {device.key: device for device in new.devices}
+    added = [device for key, device in new_devices.items() if key not in old_devices]
+    removed = [device for key, device in old_devices.items() if key not in new_devices]
+    changed = [device for key, device in new_devices.items()
+               if key in old_devices and old_devices[key] != device]
+    return added, removed, changed
+
+
+class ConfigWatcher:
+    # polls the configuration file mtime and hands a new AppConfig to on_change when it was modified
+    def __init__(self, config, on_change):
+        self.config = config
+        self.on_change = on_change
+        self._mtime = self._stat()
+
+    @staticmethod
+    def _stat():
+        try:
+            return os.stat(CONFIG_FILE).st_mtime_ns
+        except OSError:
+            return None
+
+    def check(self):
+        mtime = self._stat()
+        if mtime is None or mtime == self._mtime:
+            return
+        self._mtime = mtime
+        logging.info("* * * configuration file changed, reloading")
+        try:
+            config = AppConfig()
+        except (configparser.Error, OSError):
+            logging.exception("Error reading configuration, keeping the running one")
+            return
+        old, self.config = self.config, config
+        self.on_change(old, config)
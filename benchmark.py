@@ -0,0 +1,347 @@
+#!/usr/bin/env python
+# End to end benchmark of the RadioTemperature pipeline.
+#
+# Messages shaped like rtl_433 output are fed to on_message (or on_rtl_433_line)
+# from a generator thread standing in for the paho network thread. Services
+# are backed by a stub VeDbusService that records when each value reaches it.
+# Only GLib (PyGObject) is needed, dbus, velib_python, paho and requests are
+# replaced by stubs when they are not installed.
+#
+#   python benchmark.py --sensors 50 --rate 200 --duration 30 --repeats 3 --unknown 0.5
+#
+# With --replay a recording made with [Record] is fed instead, every model and
+# channel found in it is configured as a sensor and the run ends with the recording.
+#
+#   python benchmark.py --replay rtl_433.rec --speed 0
+
+import argparse
+import configparser
+import json
+import logging
+import os
+import random
+import resource
+import sys
+import threading
+import time
+import tracemalloc
+import types
+
+
+def _stub_module(name, **attributes):
+    module = types.ModuleType(name)
+    module.__dict__.update(attributes)
+    sys.modules[name] = module
+    return module
+
+
+class StubBus:
+    def close(self):
+        pass
+
+
+class StubVeDbusService:
+    # records the latency of every /Temperature write, a signal is counted for every changed path
+    latencies = []
+    writes = 0
+    signals = 0
+    sent = {}
+
+    def __init__(self, servicename, bus=None, register=True):
+        self.name = servicename
+        self._values = {}
+        self.key = None
+
+    def add_path(self, path, value, writeable=False, onchangecallback=None, **kwargs):
+        self._values[path] = value
+
+    def register(self):
+        pass
+
+    def __getitem__(self, path):
+        return self._values[path]
+
+    def __setitem__(self, path, value):
+        if self._set(path, value):
+            StubVeDbusService.signals += 1
+
+    def _set(self, path, value):
+        StubVeDbusService.writes += 1
+        if path == '/Temperature' and self.key in StubVeDbusService.sent:
+            StubVeDbusService.latencies.append(time.perf_counter() - StubVeDbusService.sent[self.key])
+        if self._values.get(path) == value:
+            return False
+        self._values[path] = value
+        return True
+
+
+class StubServiceContext:
+    def __init__(self, parent):
+        self.parent = parent
+        self.changed = False
+
+    def __getitem__(self, path):
+        return self.parent[path]
+
+    def __setitem__(self, path, value):
+        self.changed = self.parent._set(path, value) or self.changed
+
+
+class StubBatchingVeDbusService(StubVeDbusService):
+    # recent velib_python, the changes of a with block are sent in one ItemsChanged signal
+    def __enter__(self):
+        self._context = StubServiceContext(self)
+        return self._context
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if self._context.changed:
+            StubVeDbusService.signals += 1
+        self._context = None
+        return False
+
+
+def install_stubs(batching=True):
+    _stub_module('vedbus', VeDbusService=StubBatchingVeDbusService if batching else StubVeDbusService)
+    try:
+        import dbus  # noqa: F401
+    except ImportError:
+        class DBusException(Exception):
+            pass
+        _stub_module('dbus', SessionBus=StubBus, SystemBus=StubBus, DBusException=DBusException)
+    try:
+        import ve_utils  # noqa: F401
+    except ImportError:
+        _stub_module('ve_utils', unwrap_dbus_value=lambda value: value)
+    try:
+        import paho.mqtt.client  # noqa: F401
+    except ImportError:
+        client = _stub_module('paho.mqtt.client', Client=None, CallbackAPIVersion=None)
+        _stub_module('paho.mqtt', client=client)
+        _stub_module('paho', mqtt=sys.modules['paho.mqtt'])
+    try:
+        import requests  # noqa: F401
+    except ImportError:
+        _stub_module('requests', Session=object)
+
+
+class FakeMessage:
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+def percentile(values, p):
+    if not values:
+        return None
+    values = sorted(values)
+    return round(values[min(len(values) - 1, int(len(values) * p / 100))], 3)
+
+
+def generate(rt, args, stop, counters):
+    # stands in for the paho network thread
+    rng = random.Random(args.seed)
+    temperatures = [20.0] * args.sensors
+    interval = 1.0 / args.rate
+    next_send = time.perf_counter()
+    while not stop.is_set():
+        if rng.random() < args.unknown:
+            model, channel, sensor = "Passer-By", rng.randint(1, 8), None
+        else:
+            sensor = rng.randrange(args.sensors)
+            model, channel = "Bench-Sensor", sensor
+            temperatures[sensor] += rng.choice((-1, 1)) * rng.uniform(0.2, 1.0)
+        payload = json.dumps({
+            "time": "2024-01-01 00:00:00", "model": model, "channel": channel, "battery_ok": 1,
+            "temperature_C": round(temperatures[sensor] if sensor is not None else 10.0, 1),
+            "humidity": rng.randint(30, 90),
+        }).encode()
+        topic = "rtl_433/%s/%s" % (model, channel)
+
+        for _ in range(args.repeats):
+            if sensor is not None:
+                StubVeDbusService.sent["Bench-Sensor_%d" % sensor] = time.perf_counter()
+            if args.ingestion == "stdout":
+                rt.on_rtl_433_line(payload)
+            else:
+                rt.on_message(None, None, FakeMessage(topic, payload))
+            counters["messages"] += 1
+
+        next_send += interval
+        delay = next_send - time.perf_counter()
+        if delay > 0:
+            time.sleep(delay)
+
+
+def recorded_sensors(path):
+    from recorder import read_recording
+    from registry import json_loads
+
+    sensors = {}
+    for _, topic, payload in read_recording(path):
+        try:
+            data = json_loads(payload)
+            sensors.setdefault((data["model"], str(data["channel"])), topic)
+        except (ValueError, KeyError, TypeError):
+            continue
+    return sensors
+
+
+def replay_recording(rt, args, stop, counters):
+    from recorder import replay
+
+    def on_message(client, userdata, msg):
+        StubVeDbusService.sent[_sent_key(msg.payload)] = time.perf_counter()
+        rt.on_message(client, userdata, msg)
+
+    def on_line(line):
+        StubVeDbusService.sent[_sent_key(line)] = time.perf_counter()
+        rt.on_rtl_433_line(line)
+
+    counters["messages"] = replay(args.replay, on_message, on_line, speed=args.speed, stop=stop)
+
+
+def _sent_key(payload):
+    from registry import json_loads
+    try:
+        data = json_loads(payload)
+        return "%s_%s" % (data["model"], data["channel"])
+    except (ValueError, KeyError, TypeError):
+        return None
+
+
+def run(args):
+    install_stubs(not args.no_batch)
+    sys.path.insert(0, os.path.dirname(os.path.realpath(__file__)))
+
+    from gi.repository import GLib
+
+    import RadioTemperature as rt
+    from app_config import AppConfig
+    from ingest import IngestQueue
+    from scheduler import UpdateScheduler
+    from temperature import Temperature, TemperatureType
+
+    class BenchConfig(AppConfig):
+        # the sample configuration, without copying it to /data/conf
+        def __init__(self):
+            self.config = configparser.ConfigParser()
+            self.config.read("%s/config.sample.ini" % os.path.dirname(os.path.realpath(__file__)))
+            self.config['Setup']['debug'] = 'false'
+            self.config['Setup']['aggregate'] = 'false'
+            self.config['Online']['addDevice'] = 'false'
+            self.config.remove_section('Devices')
+            self.snapshot = self._parse()
+
+    logging.basicConfig(level=logging.WARNING)
+    config = BenchConfig()
+    rt.dbus_connection = StubBus
+    rt.scheduler = UpdateScheduler(config)
+    rt.ingest_queue = IngestQueue(rt.scheduler.apply_readings)
+    rt.registry.configure(config)
+
+    if args.replay:
+        sensors = recorded_sensors(args.replay)
+    else:
+        sensors = dict((("Bench-Sensor", str(i)), "rtl_433/Bench-Sensor/%d" % i) for i in range(args.sensors))
+
+    for (model, channel), topic in sensors.items():
+        device = Temperature("%s %s" % (model, channel), model, channel, topic or "rtl_433/%s/%s" % (model, channel),
+                             "temperature_C", TemperatureType.GENERIC.value, False, 0, 0)
+        rt.registry.add(device)
+        service = rt.create_service(config, device, args.ingestion)
+        service.dbusservice.key = service.key
+
+    tick_times = []
+    tick = rt.scheduler._tick
+
+    def timed_tick():
+        start = time.process_time()
+        result = tick()
+        tick_times.append(time.process_time() - start)
+        return result
+
+    rt.scheduler._tick = timed_tick
+    rt.scheduler.start()
+
+    tracemalloc.start()
+    memory_start = tracemalloc.get_traced_memory()[0]
+    rss_start = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    cpu_start = time.process_time()
+    wall_start = time.perf_counter()
+
+    counters = {"messages": 0}
+    stop = threading.Event()
+    mainloop = GLib.MainLoop()
+
+    def finish():
+        stop.set()
+        generator.join()
+        # let the main loop drain what is still queued
+        GLib.timeout_add(200, lambda: mainloop.quit() or False)
+        return False
+
+    if args.replay:
+        def replay_and_finish():
+            replay_recording(rt, args, stop, counters)
+            GLib.idle_add(finish)
+
+        generator = threading.Thread(target=replay_and_finish, daemon=True)
+    else:
+        generator = threading.Thread(target=generate, args=(rt, args, stop, counters), daemon=True)
+        GLib.timeout_add(int(args.duration * 1000), finish)
+    generator.start()
+    mainloop.run()
+
+    wall = time.perf_counter() - wall_start
+    cpu = time.process_time() - cpu_start
+    memory_end, memory_peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    latencies = [latency * 1000 for latency in StubVeDbusService.latencies]
+    return {
+        "sensors": len(sensors),
+        "ingestion": args.ingestion,
+        "messages": counters["messages"],
+        "messages_per_second": round(counters["messages"] / wall, 1),
+        "published": len(latencies),
+        "dbus_writes": StubVeDbusService.writes,
+        "dbus_signals": StubVeDbusService.signals,
+        "latency_ms_p50": percentile(latencies, 50),
+        "latency_ms_p95": percentile(latencies, 95),
+        "latency_ms_p99": percentile(latencies, 99),
+        "cpu_percent": round(100 * cpu / wall, 1),
+        "ticks": len(tick_times),
+        "tick_cpu_ms_mean": round(1000 * sum(tick_times) / len(tick_times), 3) if tick_times else None,
+        "tick_cpu_ms_max": round(1000 * max(tick_times), 3) if tick_times else None,
+        "memory_growth_kb": round((memory_end - memory_start) / 1024, 1),
+        "memory_peak_kb": round(memory_peak / 1024, 1),
+        "max_rss_growth_kb": resource.getrusage(resource.RUSAGE_SELF).ru_maxrss - rss_start,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="RadioTemperature pipeline benchmark")
+    parser.add_argument("--sensors", type=int, default=15, help="number of configured sensors")
+    parser.add_argument("--rate", type=float, default=50, help="transmissions per second")
+    parser.add_argument("--duration", type=float, default=10, help="seconds to run")
+    parser.add_argument("--repeats", type=int, default=1, help="copies of each transmission, as sent by sensors")
+    parser.add_argument("--unknown", type=float, default=0.0, help="fraction of transmissions from unknown sensors")
+    parser.add_argument("--ingestion", choices=("mqtt", "stdout"), default="mqtt")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--no-batch", action="store_true",
+                        help="stub velib_python without batched ItemsChanged, one signal per changed path")
+    parser.add_argument("--replay", metavar="FILE", help="feed a recording instead of generated transmissions")
+    parser.add_argument("--speed", type=float, default=0, help="replay speed, 0 for as fast as possible")
+    parser.add_argument("--json", action="store_true", help="print the results as json")
+    args = parser.parse_args()
+
+    results = run(args)
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for key, value in results.items():
+            print("%-22s %s" % (key, value))
+
+
+if __name__ == "__main__":
+    main()
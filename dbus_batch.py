@@ -0,0 +1,25 @@
+class DirectBatch:
+    # velib_python without the VeDbusService context manager, every changed path is sent on its own
+    def __init__(self, service):
+        self.service = service
+
+    def __getitem__(self, path):
+        return self.service[path]
+
+    def __setitem__(self, path, value):
+        if self.service[path] != value:
+            self.service[path] = value
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        return False
+
+
+def batched(service):
+    # a recent VeDbusService collects the values set in a with block and sends the changed
+    # ones in a single ItemsChanged signal on exit, instead of a PropertiesChanged per path
+    if hasattr(service, '__enter__'):
+        return service
+    return DirectBatch(service)
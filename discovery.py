@@ -0,0 +1,97 @@
+import json
+import logging
+import os
+import threading
+import time
+from collections import OrderedDict
+
+from gi.repository import GLib
+
+from registry import device_key, json_loads
+
+
+class DeviceDiscovery:
+    # registers unknown rtl_433 model/channel pairs as new devices, keeping at most
+    # max_devices of them and dropping the least recently seen one when full
+    def __init__(self, path, max_devices, temperature_field, register, unregister):
+        self.path = path
+        self.max_devices = max_devices
+        self.temperature_field = temperature_field
+        self.register = register
+        self.unregister = unregister
+
+        # key -> device info, least recently seen first
+        self.active = OrderedDict()
+        self._pending = set()
+        self._lock = threading.Lock()
+        self._dirty = False
+
+    def observe(self, payload, topic=None):
+        # called for payloads no configured device matched, from any thread
+        data = json_loads(payload)
+        model = data.get("model")
+        if model is None or self.temperature_field not in data:
+            return
+        channel = data.get("channel")
+        key = device_key(model, channel)
+        with self._lock:
+            if key in self._pending:
+                return
+            self._pending.add(key)
+        GLib.idle_add(self._discovered, key, {"model": model, "channel": channel, "topic": topic}, data)
+
+    def _discovered(self, key, info, data):
+        with self._lock:
+            self._pending.discard(key)
+        if key in self.active:
+            return False
+        logging.info("* * * discovered new device %s" % key)
+        info["last_seen"] = time.time()
+        self._add(key, info, data)
+        return False
+
+    def _add(self, key, info, data=None):
+        while len(self.active) >= self.max_devices:
+            old_key, _ = self.active.popitem(last=False)
+            logging.info("* * * too many discovered devices, removing %s" % old_key)
+            self.unregister(old_key)
+        try:
+            self.register(key, info, data)
+        except Exception:
+            logging.exception("Error registering discovered device %s" % key)
+            return
+        self.active[key] = info
+        self._dirty = True
+
+    def touch(self, key):
+        info = self.active.get(key)
+        if info is not None:
+            info["last_seen"] = time.time()
+            self.active.move_to_end(key)
+            self._dirty = True
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as file:
+                devices = json.load(file)
+        except (OSError, ValueError):
+            logging.exception("Error reading discovered devices %s" % self.path)
+            return
+        devices.sort(key=lambda info: info.get("last_seen", 0))
+        for info in devices[-self.max_devices:]:
+            self._add(device_key(info["model"], info.get("channel")), info)
+        self._dirty = False
+
+    def save(self):
+        if not self._dirty:
+            return
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, 'w') as file:
+                json.dump(list(self.active.values()), file)
+            os.replace(tmp, self.path)
+            self._dirty = False
+        except OSError:
+            logging.exception("Error writing discovered devices %s" % self.path)
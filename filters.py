@@ -0,0 +1,130 @@
+import logging
+from collections import deque
+from enum import Enum
+
+# consecutive rejected readings after which a jump is taken as a real change
+OUTLIER_LIMIT = 3
+
+
+class Smoothing(Enum):
+    NONE = "none"
+    MEDIAN = "median"
+    EWMA = "ewma"
+    KALMAN = "kalman"
+
+
+class MedianSmoother:
+    def __init__(self, size):
+        self.values = deque(maxlen=size)
+
+    def add(self, value):
+        self.values.append(value)
+        ordered = sorted(self.values)
+        n = len(ordered)
+        if n % 2:
+            return ordered[n // 2]
+        return (ordered[n // 2 - 1] + ordered[n // 2]) / 2
+
+
+class EwmaSmoother:
+    def __init__(self, alpha):
+        self.alpha = alpha
+        self.value = None
+
+    def add(self, value):
+        if self.value is None:
+            self.value = value
+        else:
+            self.value += self.alpha * (value - self.value)
+        return self.value
+
+
+class KalmanSmoother:
+    # one dimensional kalman filter of a slowly changing value
+    def __init__(self, process_noise, measurement_noise):
+        self.q = process_noise
+        self.r = measurement_noise
+        self.value = None
+        self.error = 1.0
+
+    def add(self, value):
+        if self.value is None:
+            self.value = value
+            return value
+        self.error += self.q
+        gain = self.error / (self.error + self.r)
+        self.value += gain * (value - self.value)
+        self.error *= 1 - gain
+        return self.value
+
+
+class ReadingFilter:
+    # per device stage between decoding and the Temperature update: drops the repeats
+    # rtl_433 reports for a single transmission, rejects spikes and smooths the rest
+    def __init__(self, name, duplicate_window, max_jump, smoothers=None):
+        self.name = name
+        self.duplicate_window = duplicate_window
+        self.max_jump = max_jump
+        # temperature and humidity smoothers
+        self.smoothers = smoothers
+        self._payload = None
+        self._payload_time = 0
+        self._values = None
+        self._values_time = 0
+        self._accepted = None
+        self._rejected = 0
+
+    def repeated(self, payload, now):
+        # the copies of a transmission usually carry the very same payload, checked before decoding it
+        digest = hash(payload)
+        if digest == self._payload and now - self._payload_time <= self.duplicate_window:
+            return True
+        self._payload = digest
+        self._payload_time = now
+        return False
+
+    def apply(self, reading, now):
+        # returns the reading to publish or None when it is dropped
+        if self.duplicate_window:
+            values = (reading['temperature'], reading['humidity'], reading['pressure'])
+            if values == self._values and now - self._values_time <= self.duplicate_window:
+                return None
+            self._values = values
+            self._values_time = now
+
+        temperature = reading['temperature']
+        if self.max_jump and temperature is not None and self._accepted is not None \
+                and abs(temperature - self._accepted) > self.max_jump:
+            self._rejected += 1
+            if self._rejected < OUTLIER_LIMIT:
+                logging.debug("* * * %s: %s rejected, last %s", self.name, temperature, self._accepted)
+                return None
+        self._rejected = 0
+        if temperature is not None:
+            self._accepted = temperature
+
+        if self.smoothers is not None:
+            if temperature is not None:
+                reading['temperature'] = round(self.smoothers[0].add(temperature), 2)
+            if reading['humidity'] is not None:
+                reading['humidity'] = round(self.smoothers[1].add(reading['humidity']), 1)
+        return reading
+
+
+def create_filter(config, device):
+    smoothing = device.smoothing or config.get_smoothing()
+    if smoothing == Smoothing.MEDIAN.value:
+        smoothers = tuple(MedianSmoother(config.get_median_size()) for _ in range(2))
+    elif smoothing == Smoothing.EWMA.value:
+        smoothers = tuple(EwmaSmoother(config.get_ewma_alpha()) for _ in range(2))
+    elif smoothing == Smoothing.KALMAN.value:
+        smoothers = tuple(KalmanSmoother(config.get_kalman_process_noise(), config.get_kalman_measurement_noise())
+                          for _ in range(2))
+    else:
+        if smoothing != Smoothing.NONE.value:
+            logging.error("Unknown smoothing %s for %s, not smoothed" % (smoothing, device.name))
+        smoothers = None
+
+    if smoothers is None and not config.get_duplicate_window() and not config.get_max_jump():
+        return None
+    return ReadingFilter(device.name, config.get_duplicate_window(), config.get_max_jump(), smoothers)
@@ -0,0 +1,81 @@
+import logging
+
+from dbus import DBusException
+
+from ve_utils import unwrap_dbus_value
+
+LATITUDE = '/Position/Latitude'
+LONGITUDE = '/Position/Longitude'
+
+
+class GpsTracker:
+    # keeps the latest fix of the gps service in memory, updated by its dbus
+    # signals, and follows the service when it disappears and comes back
+    def __init__(self, bus, service):
+        self.bus = bus
+        self.service = service
+        self.latitude = None
+        self.longitude = None
+        self._signals = []
+        self._watch = bus.watch_name_owner(service, self._on_owner_changed)
+
+    def position(self):
+        if self.latitude is None or self.longitude is None:
+            return None
+        return self.latitude, self.longitude
+
+    def _on_owner_changed(self, owner):
+        self._disconnect()
+        if not owner:
+            logging.info("* * * GPS %s not connected" % self.service)
+            return
+        logging.info("* * * GPS %s connected" % self.service)
+        self._connect()
+
+    def _connect(self):
+        self._signals.append(self.bus.add_signal_receiver(
+            self._on_properties_changed, signal_name='PropertiesChanged', dbus_interface='com.victronenergy.BusItem',
+            bus_name=self.service, path_keyword='path'))
+        self._signals.append(self.bus.add_signal_receiver(
+            self._on_items_changed, signal_name='ItemsChanged', dbus_interface='com.victronenergy.BusItem',
+            bus_name=self.service, path='/'))
+
+        try:
+            self.latitude = self._get_value(LATITUDE)
+            self.longitude = self._get_value(LONGITUDE)
+            logging.debug("* * * latitude: %s, longitude: %s", self.latitude, self.longitude)
+        except DBusException:
+            logging.exception("* * * GPS not connected")
+
+    def _disconnect(self):
+        for match in self._signals:
+            match.remove()
+        self._signals = []
+        self.latitude = None
+        self.longitude = None
+
+    def _get_value(self, path):
+        return self._unwrap(self.bus.get_object(self.service, path, introspect=False).GetValue())
+
+    def _on_properties_changed(self, changes, path=None):
+        if 'Value' in changes:
+            self._set(path, changes['Value'])
+
+    def _on_items_changed(self, items):
+        for path, changes in items.items():
+            if 'Value' in changes:
+                self._set(path, changes['Value'])
+
+    def _set(self, path, value):
+        if path == LATITUDE:
+            self.latitude = self._unwrap(value)
+        elif path == LONGITUDE:
+            self.longitude = self._unwrap(value)
+
+    @staticmethod
+    def _unwrap(value):
+        value = unwrap_dbus_value(value)
+        # invalid values are sent as an empty array
+        if value == []:
+            return None
+        return value
@@ -0,0 +1,118 @@
+import math
+from array import array
+from collections import deque
+
+
+def window_name(seconds):
+    if seconds % 86400 == 0 and seconds > 86400:
+        return "%dd" % (seconds // 86400)
+    if seconds % 3600 == 0:
+        return "%dh" % (seconds // 3600)
+    return "%dm" % (seconds // 60)
+
+
+class HistoryTier:
+    # fixed size ring of bucket averages, each bucket covers `resolution` seconds.
+    # memory is 8 bytes per bucket plus at most `size` entries in each min/max deque
+    def __init__(self, resolution, size):
+        self.resolution = resolution
+        self.size = size
+        self.name = window_name(resolution * size)
+        self.buckets = array('i', [0]) * size
+        self.values = array('f', [0.0]) * size
+        self.count = 0
+        self.total = 0.0
+
+        # sequence numbers of pushed buckets, oldest is `_seq - count`
+        self._seq = 0
+        self._min = deque()
+        self._max = deque()
+
+        self._bucket = None
+        self._sum = 0.0
+        self._n = 0
+
+    def add(self, timestamp, value):
+        # returns True when a bucket was closed and the statistics changed
+        bucket = int(timestamp // self.resolution)
+        closed = False
+        if self._bucket is not None and bucket != self._bucket and self._n > 0:
+            self._push(self._bucket, self._sum / self._n)
+            closed = True
+        if bucket != self._bucket:
+            self._bucket = bucket
+            self._sum = 0.0
+            self._n = 0
+        self._sum += value
+        self._n += 1
+
+        # drop buckets that fell out of the window while the sensor was silent
+        while self.count > 0 and self.buckets[(self._seq - self.count) % self.size] <= bucket - self.size:
+            self._evict()
+            closed = True
+        return closed
+
+    def _push(self, bucket, value):
+        if self.count == self.size:
+            self._evict()
+        seq = self._seq
+        i = seq % self.size
+        self.buckets[i] = bucket
+        self.values[i] = value
+        value = self.values[i]
+        self.total += value
+        self.count += 1
+        self._seq += 1
+
+        while self._min and self.values[self._min[-1] % self.size] >= value:
+            self._min.pop()
+        self._min.append(seq)
+        while self._max and self.values[self._max[-1] % self.size] <= value:
+            self._max.pop()
+        self._max.append(seq)
+
+    def _evict(self):
+        seq = self._seq - self.count
+        self.total -= self.values[seq % self.size]
+        self.count -= 1
+        if self._min and self._min[0] == seq:
+            self._min.popleft()
+        if self._max and self._max[0] == seq:
+            self._max.popleft()
+
+    def minimum(self):
+        return round(self.values[self._min[0] % self.size], 2) if self.count else None
+
+    def maximum(self):
+        return round(self.values[self._max[0] % self.size], 2) if self.count else None
+
+    def average(self):
+        return round(self.total / self.count, 2) if self.count else None
+
+
+class SensorHistory:
+    QUANTITIES = ('Temperature', 'Humidity')
+
+    def __init__(self, tiers):
+        self.tiers = {quantity: [HistoryTier(resolution, size) for resolution, size in tiers]
+                      for quantity in self.QUANTITIES}
+
+    def paths(self):
+        for quantity, tiers in self.tiers.items():
+            for tier in tiers:
+                for stat in ('Min', 'Max', 'Average'):
+                    yield '/History/%s/%s/%s' % (tier.name, quantity, stat)
+
+    def add(self, timestamp, temperature, humidity):
+        # returns the paths whose value changed
+        changes = {}
+        for quantity, value in (('Temperature', temperature), ('Humidity', humidity)):
+            if value is None or (isinstance(value, float) and math.isnan(value)):
+                continue
+            for tier in self.tiers[quantity]:
+                if tier.add(timestamp, value):
+                    prefix = '/History/%s/%s/' % (tier.name, quantity)
+                    changes[prefix + 'Min'] = tier.minimum()
+                    changes[prefix + 'Max'] = tier.maximum()
+                    changes[prefix + 'Average'] = tier.average()
+        return changes
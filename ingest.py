@@ -0,0 +1,44 @@
+import logging
+import threading
+
+from gi.repository import GLib
+
+# absorbs the float error of values like 22.3 - 22.2 compared to a 0.1 deadband
+DEADBAND_TOLERANCE = 1e-9
+
+
+def exceeds_deadband(old, new, deadband):
+    if old is None or new is None:
+        return old != new
+    # a change of exactly the deadband, one sensor resolution step, is published
+    return new != old and abs(new - old) >= deadband - DEADBAND_TOLERANCE
+
+
+class IngestQueue:
+    # hands readings from the mqtt network thread over to the GLib main loop,
+    # keeping only the newest reading of each device until the main loop drains it
+    def __init__(self, handler):
+        self.handler = handler
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._scheduled = False
+
+    def put(self, key, reading):
+        with self._lock:
+            self._pending[key] = reading
+            if self._scheduled:
+                return
+            self._scheduled = True
+        GLib.idle_add(self._drain)
+
+    def _drain(self):
+        with self._lock:
+            pending = self._pending
+            self._pending = {}
+            self._scheduled = False
+
+        try:
+            self.handler(pending)
+        except Exception:
+            logging.exception("Error applying received readings")
+        return False
@@ -0,0 +1,133 @@
+import bisect
+import logging
+import os
+import time
+
+# every counter has a single writer thread, readers may see a value one update late
+
+
+class Counter:
+    def __init__(self, name, help_text):
+        self.name = name
+        self.help = help_text
+        self.value = 0
+
+    def inc(self, amount=1):
+        self.value += amount
+
+    def samples(self):
+        yield self.name + "_total", self.value
+
+
+class Gauge:
+    def __init__(self, name, help_text, getter):
+        self.name = name
+        self.help = help_text
+        self.getter = getter
+
+    def samples(self):
+        yield self.name, self.getter()
+
+
+class Histogram:
+    def __init__(self, name, help_text, buckets):
+        self.name = name
+        self.help = help_text
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def average(self):
+        return self.sum / self.count if self.count else 0
+
+    def samples(self):
+        total = 0
+        for bucket, count in zip(self.buckets, self.counts):
+            total += count
+            yield '%s_bucket{le="%s"}' % (self.name, bucket), total
+        yield '%s_bucket{le="+Inf"}' % self.name, self.count
+        yield self.name + "_sum", self.sum
+        yield self.name + "_count", self.count
+
+
+class Metrics:
+    def __init__(self, prefix="radiotemperature"):
+        self.prefix = prefix
+        self._metrics = []
+
+    def counter(self, name, help_text):
+        return self._add(Counter("%s_%s" % (self.prefix, name), help_text))
+
+    def gauge(self, name, help_text, getter):
+        return self._add(Gauge("%s_%s" % (self.prefix, name), help_text, getter))
+
+    def histogram(self, name, help_text, buckets):
+        return self._add(Histogram("%s_%s" % (self.prefix, name), help_text, buckets))
+
+    def _add(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def textfile(self):
+        lines = []
+        for metric in self._metrics:
+            kind = {Counter: "counter", Gauge: "gauge", Histogram: "histogram"}[type(metric)]
+            lines.append("# HELP %s %s" % (metric.name, metric.help))
+            lines.append("# TYPE %s %s" % (metric.name, kind))
+            for name, value in metric.samples():
+                lines.append("%s %s" % (name, value))
+        return "\n".join(lines) + "\n"
+
+    def write_textfile(self, path):
+        # node exporter must never see a partial file
+        tmp = "%s.%d.tmp" % (path, os.getpid())
+        try:
+            with open(tmp, 'w') as file:
+                file.write(self.textfile())
+            os.replace(tmp, path)
+        except OSError:
+            logging.exception("Error writing metrics to %s" % path)
+
+
+class RateLimitFilter(logging.Filter):
+    # lets through at most `burst` debug records of the same message template per `interval` seconds
+    def __init__(self, interval=60, burst=10):
+        super().__init__()
+        self.interval = interval
+        self.burst = burst
+        self._windows = {}
+
+    def filter(self, record):
+        if record.levelno > logging.DEBUG:
+            return True
+        now = time.monotonic()
+        if len(self._windows) > 1000:
+            # eagerly formatted messages make every record unique
+            self._windows.clear()
+        window = self._windows.get(record.msg)
+        if window is None or now - window[0] >= self.interval:
+            self._windows[record.msg] = [now, 1]
+            return True
+        window[1] += 1
+        return window[1] <= self.burst
+
+
+metrics = Metrics()
+
+messages_received = metrics.counter("messages_received", "Messages received from rtl_433")
+messages_parsed = metrics.counter("messages_parsed", "Messages decoded for a known device")
+messages_dropped = metrics.counter("messages_dropped", "Messages of unknown devices")
+messages_filtered = metrics.counter("messages_filtered", "Repeated transmissions and rejected outliers")
+parse_errors = metrics.counter("parse_errors", "Messages that could not be decoded")
+update_duration = metrics.histogram("update_duration_seconds", "Duration of a scheduler tick",
+                                    (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25))
+provider_latency = metrics.histogram("provider_fetch_seconds", "Duration of an online weather fetch",
+                                     (0.25, 0.5, 1, 2.5, 5, 10, 20, 30))
+provider_failures = metrics.counter("provider_failures", "Online weather fetches without valid conditions")
+mqtt_reconnects = metrics.counter("mqtt_reconnects", "Unexpected MQTT disconnections")
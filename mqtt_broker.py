@@ -1,14 +1,22 @@
 import logging
+import random
 
 import paho.mqtt.client as mqtt
 import paho.mqtt.client as mqtt_client
 
+from metrics import mqtt_reconnects
+
 
 class Broker:
-    def __init__(self, name, address, port):
+    def __init__(self, name, address, port, qos=0, subscription=None, reconnect_min=1, reconnect_max=120):
         self.name = name
         self.address = address
         self.port = port
+        self.qos = qos
+        # single wildcard subscription, when empty every configured topic is subscribed
+        self.subscription = subscription
+        self.reconnect_min = reconnect_min
+        self.reconnect_max = reconnect_max
 
         self.client = mqtt.Client(mqtt_client.CallbackAPIVersion.VERSION1, self.name)
 
@@ -20,18 +28,33 @@ class Broker:
     def connect_broker(self):
 
         try:
-            logging.info('connecting to MQTTBroker ' + self.address + ' on Port ' + str(self.port))
-
             if self.address is not None:
-                self.client.connect(self.address, port=self.port)  # connect to broker
+                logging.info('connecting to MQTTBroker ' + self.address + ' on Port ' + str(self.port))
+                self._set_reconnect_delay()
+                # paho's network thread connects and reconnects with exponential backoff
+                self.client.connect_async(self.address, port=self.port)
                 self.client.loop_start()
             else:
                 logging.error("couldn't connect to MQTT Broker")
         except Exception as e:
             logging.exception("Error in Connect to Broker")
             logging.exception(e)
-            logging.debug("Retrying...")
-            self.connect_broker()
+
+    def _set_reconnect_delay(self):
+        # jitter the first retry so several clients do not reconnect in lockstep
+        self.client.reconnect_delay_set(max(1, round(self.reconnect_min * random.uniform(0.5, 1.5))),
+                                        self.reconnect_max)
+
+    def subscribe(self, topic):
+        # topics added at runtime, already covered by a wildcard subscription
+        if not self.subscription:
+            self.client.subscribe(topic, self.qos)
+            logging.info("Subscribed to: " + topic)
+
+    def unsubscribe(self, topic):
+        if not self.subscription:
+            self.client.unsubscribe(topic)
+            logging.info("Unsubscribed from: " + topic)
 
     def on_message(self, on_message):
         self.client.on_message = on_message
@@ -40,25 +63,22 @@ class Broker:
         logging.info("Client Got Disconnected")
         if rc != 0:
             logging.info('Unexpected MQTT disconnection. Will auto-reconnect')
+            mqtt_reconnects.inc()
+            self._set_reconnect_delay()
         else:
             logging.info('rc value:' + str(rc))
-        try:
-            logging.info("Trying to Reconnect")
-            self.connect_broker()
-        except Exception as e:
-            logging.exception("Error in Retrying to Connect with Broker")
-            logging.exception(e)
-
 
     def on_connect(self, client, userdata, flags, rc):
         if rc == 0:
             logging.info("Connected to MQTT Broker!")
-            # subscribe to all topics we have in dict
-            if len(self.topic_category) > 0:
-                for topic in self.topic_category.keys():
-                    client.subscribe(topic)
-                    logging.info("Subscribed to: " + topic)
+            if self.subscription:
+                client.subscribe(self.subscription, self.qos)
+                logging.info("Subscribed to: " + self.subscription)
+            elif len(self.topic_category) > 0:
+                # subscribe to all topics we have in dict with a single request
+                client.subscribe([(topic, self.qos) for topic in self.topic_category.keys()])
+                logging.info("Subscribed to: " + ", ".join(self.topic_category.keys()))
             else:
                 logging.info("No Topic to subscribe, please configure in config.ini")
         else:
-            logging.info("Failed to connect, return code %d\n", rc)
\ No newline at end of file
+            logging.info("Failed to connect, return code %d\n", rc)
@@ -1,71 +1,132 @@
 import logging
+import threading
+import time
 from abc import ABC, abstractmethod
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
 from datetime import datetime
 from enum import Enum
 
 import requests
 
+# http status of a provider rate limiting us
+TOO_MANY_REQUESTS = 429
+
+class QuotaExceeded(Exception):
+    pass
+
+
 class ProviderType(Enum):
     WUNDERGROUD="wunderground"
     OPENWEATHER="openweather"
 
 class WeatherProvider(ABC):
-    def __init__(self, api_key, units):
+    def __init__(self, api_key, units, connect_timeout=5, read_timeout=15):
         self.api_key = api_key
         self.conditions = {"valid": False}
         self.units = units
+        # one pooled session per provider, connections are kept alive between fetches
+        self.session = requests.Session()
+        self.timeout = (connect_timeout, read_timeout)
+        # optional WeatherCache remembering the nearest station of each position cell
+        self.cache = None
+        self.name = self.__class__.__name__
+        self.quota = None
+        self.last_status = None
+
+    def _get(self, url):
+        if self.quota is not None and not self.quota.take():
+            raise QuotaExceeded("%s daily quota of %d requests used" % (self.name, self.quota.daily_limit))
+        response = self.session.get(url, timeout=self.timeout)
+        self.last_status = response.status_code
+        return response
 
     @abstractmethod
     def get_weather(self, latitude, longitude):
         pass
 
 class WundergroundProvider(WeatherProvider):
-    def __init__(self, api_key, units):
+    def __init__(self, api_key, units, connect_timeout=5, read_timeout=15):
         if units == "metric":
             units = "m"
         elif units == "imperial":
             units = "e"
 
-        super().__init__(api_key, units)
+        super().__init__(api_key, units, connect_timeout, read_timeout)
         self.base_url = "https://api.weather.com"
 
     def get_weather(self, latitude, longitude):
         if self.api_key is None:
             pass
+        self.conditions['valid'] = False
         try:
-            response = requests.get(f"{self.base_url}/v3/location/near?geocode={latitude},{longitude}&product=pws&format=json&apiKey={self.api_key}")
-            if response.status_code == 200:
-                data = response.json()
-                city = data["location"]["stationName"][0]
-                pws = data["location"]["stationId"][0]
-
-                self.conditions['city'] = city
+            station = self.find_station(latitude, longitude)
+            if station is not None:
+                self.conditions['city'] = station["name"]
 
-                response = requests.get(f"{self.base_url}/v2/pws/observations/current?stationId={pws}&format=json&units={self.units}&apiKey={self.api_key}")
-                if response.status_code == 200:
-                    data = response.json()
-                    self.conditions['temperature'] = data["observations"][0]["metric"]["temp"]
-                    self.conditions['humidity'] = data["observations"][0]["humidity"]
-                    self.conditions['last_update'] = datetime.now()
-                    self.conditions['valid'] = True
+                response = self._get(f"{self.base_url}/v2/pws/observations/current?stationId={station['id']}&format=json&units={self.units}&apiKey={self.api_key}")
+                if response.status_code != 200:
+                    logging.debug("Failed to get weather data: status code is %s" % response.status_code)
+                    self.forget_station(latitude, longitude)
+                    return
+                try:
+                    observation = response.json()["observations"][0]
+                    # the values are under the name of the requested units
+                    temperature = observation["imperial" if self.units == "e" else "metric"]["temp"]
+                    humidity = observation["humidity"]
+                except (ValueError, KeyError, IndexError, TypeError):
+                    self.forget_station(latitude, longitude)
+                    raise
+                self.conditions['temperature'] = temperature
+                self.conditions['humidity'] = humidity
+                self.conditions['last_update'] = datetime.now()
+                self.conditions['valid'] = True
             else:
-                logging.debug("Failed to get weather data: status code is %s" % response.status_code)
                 self.conditions['valid'] = False
+        except QuotaExceeded as e:
+            logging.warning(str(e))
         except Exception:
             logging.exception("Failed to get weather data")
             self.conditions['valid'] = False
 
+    def find_station(self, latitude, longitude):
+        cell = None
+        if self.cache is not None:
+            cell = self.cache.cell(latitude, longitude)
+            station = self.cache.get_station(cell)
+            if station is not None:
+                logging.debug("* * * cached station %s for cell %s", station["id"], cell)
+                return station
+
+        response = self._get(f"{self.base_url}/v3/location/near?geocode={latitude},{longitude}&product=pws&format=json&apiKey={self.api_key}")
+        if response.status_code != 200:
+            logging.debug("Failed to get weather data: status code is %s" % response.status_code)
+            return None
+
+        data = response.json()
+        station = {"id": data["location"]["stationId"][0], "name": data["location"]["stationName"][0]}
+        if self.cache is not None:
+            self.cache.put_station(cell, station)
+        return station
+
+    def forget_station(self, latitude, longitude):
+        # the station went offline or stopped reporting, look up the nearest one again next time
+        if self.cache is not None:
+            cell = self.cache.cell(latitude, longitude)
+            logging.debug("* * * dropping cached station of cell %s", cell)
+            self.cache.drop_station(cell)
+
 
 class OpenweatherProvider(WeatherProvider):
-    def __init__(self, api_key, units):
-        super().__init__(api_key, units)
+    def __init__(self, api_key, units, connect_timeout=5, read_timeout=15):
+        super().__init__(api_key, units, connect_timeout, read_timeout)
         self.base_url = "https://api.openweathermap.org/data/2.5/weather"
 
     def get_weather(self, latitude, longitude):
         if self.api_key is None:
             pass
+        self.conditions['valid'] = False
         try:
-            response = requests.get(f"{self.base_url}?lat={latitude}&lon={longitude}&units={self.units}&appid={self.api_key}")
+            response = self._get(f"{self.base_url}?lat={latitude}&lon={longitude}&units={self.units}&appid={self.api_key}")
             if response.status_code == 200:
                 data = response.json()
                 city = data["name"]
@@ -78,6 +139,161 @@ class OpenweatherProvider(WeatherProvider):
                 logging.debug("Failed to get weather data: status code is %s" % response.status_code)
                 self.conditions['valid'] = False
                 self.conditions['valid'] = False
+        except QuotaExceeded as e:
+            logging.warning(str(e))
         except Exception:
             logging.exception("Failed to get weather data")
             self.conditions['valid'] = False
+
+
+class Quota:
+    # requests made in the current utc day, providers count their quota per utc day
+    def __init__(self, daily_limit):
+        self.daily_limit = daily_limit
+        self.day = None
+        self.used = 0
+
+    def take(self):
+        day = time.gmtime()[:3]
+        if day != self.day:
+            self.day = day
+            self.used = 0
+        if self.used >= self.daily_limit:
+            return False
+        self.used += 1
+        return True
+
+    def exhausted(self):
+        return self.day == time.gmtime()[:3] and self.used >= self.daily_limit
+
+
+class CircuitBreaker:
+    # after failure_threshold failures in a row a provider is not asked again until the
+    # cooldown ends, then a single request decides whether it is closed again
+    def __init__(self, name, failure_threshold=3, cooldown=600):
+        self.name = name
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.failures = 0
+        self.open_until = 0
+
+    def available(self, now):
+        return now >= self.open_until
+
+    def success(self):
+        if self.failures >= self.failure_threshold:
+            logging.info("* * * %s available again" % self.name)
+        self.failures = 0
+        self.open_until = 0
+
+    def failure(self, now, trip=False):
+        self.failures += 1
+        if trip:
+            self.failures = max(self.failures, self.failure_threshold)
+        if self.failures >= self.failure_threshold:
+            self.open_until = now + self.cooldown
+            logging.warning("%s failed %d times, not used for %ds" % (self.name, self.failures, self.cooldown))
+
+
+class ProviderChain:
+    # asks the providers in order of preference, the next one is asked as well when an answer
+    # takes longer than hedge_delay or is not valid, the first valid answer wins.
+    # It has the get_weather/conditions interface of a single provider
+    def __init__(self, providers, hedge_delay=3, failure_threshold=3, cooldown=600):
+        self.providers = providers
+        self.hedge_delay = hedge_delay
+        self.breakers = {provider: CircuitBreaker(provider.name, failure_threshold, cooldown)
+                         for provider in providers}
+        self.conditions = {"valid": False}
+        self._executor = ThreadPoolExecutor(max_workers=len(providers), thread_name_prefix="provider")
+        # provider -> request still running, a provider is never asked twice at the same time
+        self._running = {}
+        self._lock = threading.Lock()
+
+    @property
+    def cache(self):
+        return self.providers[0].cache
+
+    @cache.setter
+    def cache(self, cache):
+        for provider in self.providers:
+            provider.cache = cache
+
+    def _call(self, provider, latitude, longitude):
+        provider.get_weather(latitude, longitude)
+        conditions = dict(provider.conditions)
+        now = time.monotonic()
+        with self._lock:
+            if conditions.get("valid"):
+                self.breakers[provider].success()
+            elif provider.quota is None or not provider.quota.exhausted():
+                self.breakers[provider].failure(now, trip=provider.last_status == TOO_MANY_REQUESTS)
+        return conditions
+
+    def _candidates(self):
+        now = time.monotonic()
+        candidates = []
+        for provider in self.providers:
+            if provider.quota is not None and provider.quota.exhausted():
+                continue
+            with self._lock:
+                if not self.breakers[provider].available(now):
+                    continue
+            running = self._running.get(provider)
+            if running is not None and not running.done():
+                logging.debug("* * * %s still running", provider.name)
+                continue
+            candidates.append(provider)
+        return candidates
+
+    def get_weather(self, latitude, longitude):
+        self.conditions = {"valid": False}
+        candidates = self._candidates()
+        if not candidates:
+            logging.debug("* * * no weather provider available")
+            return
+
+        pending = set()
+        while candidates or pending:
+            if candidates:
+                provider = candidates.pop(0)
+                future = self._executor.submit(self._call, provider, latitude, longitude)
+                self._running[provider] = future
+                pending.add(future)
+            # wait for an answer, the next provider is asked when it is late or invalid
+            done, pending = wait(pending, timeout=self.hedge_delay if candidates else None,
+                                 return_when=FIRST_COMPLETED)
+            for future in done:
+                conditions = future.result()
+                if conditions.get("valid"):
+                    # requests still running finish on their own and update their breaker
+                    self.conditions = conditions
+                    return
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+
+
+def create_provider(name, api_key, units, connect_timeout=5, read_timeout=15, daily_limit=0):
+    if name == ProviderType.WUNDERGROUD.value:
+        provider = WundergroundProvider(api_key, units, connect_timeout, read_timeout)
+    elif name == ProviderType.OPENWEATHER.value:
+        provider = OpenweatherProvider(api_key, units, connect_timeout, read_timeout)
+    else:
+        logging.error("Unknown weather provider %s" % name)
+        return None
+    provider.name = name
+    if daily_limit > 0:
+        provider.quota = Quota(daily_limit)
+    return provider
+
+
+def create_provider_chain(providers, units, connect_timeout=5, read_timeout=15, hedge_delay=3, failure_threshold=3,
+                          cooldown=600):
+    # providers: (name, api key, daily request limit) in order of preference
+    providers = [create_provider(name, api_key, units, connect_timeout, read_timeout, daily_limit)
+                 for name, api_key, daily_limit in providers]
+    providers = [provider for provider in providers if provider is not None]
+    if not providers:
+        return None
+    return ProviderChain(providers, hedge_delay, failure_threshold, cooldown)
@@ -0,0 +1,121 @@
+import gzip
+import logging
+import os
+import struct
+import threading
+import time
+
+MAGIC = b'RTREC1\n'
+GZIP_MAGIC = b'\x1f\x8b'
+# timestamp, topic length (0 for rtl_433 stdout lines), payload length
+RECORD = struct.Struct('<dHI')
+
+
+class RecordedMessage:
+    # stands in for the paho message when a recording is replayed
+    def __init__(self, topic, payload):
+        self.topic = topic
+        self.payload = payload
+
+
+class TrafficRecorder:
+    # appends every raw payload to a binary log, rotated to <path>.1 when it grows past max_size bytes
+    def __init__(self, path, max_size, compress=True):
+        self.path = path
+        self.max_size = max_size
+        self.compress = compress
+        self._raw = None
+        self._file = None
+        self._lock = threading.Lock()
+
+    def _open(self):
+        self._raw = open(self.path, 'ab')
+        empty = self._raw.tell() == 0
+        self._file = gzip.GzipFile(fileobj=self._raw, mode='ab') if self.compress else self._raw
+        if empty:
+            self._file.write(MAGIC)
+
+    def _close(self):
+        if self._file is not self._raw:
+            self._file.close()
+        self._raw.close()
+        self._file = None
+        self._raw = None
+
+    def record(self, topic, payload):
+        # called from the mqtt network thread and from the main loop
+        if isinstance(payload, str):
+            payload = payload.encode()
+        topic = topic.encode() if topic else b''
+        with self._lock:
+            try:
+                if self._file is None:
+                    self._open()
+                self._file.write(RECORD.pack(time.time(), len(topic), len(payload)))
+                self._file.write(topic)
+                self._file.write(payload)
+                if self._raw.tell() >= self.max_size:
+                    self._rotate()
+            except OSError:
+                logging.exception("Error recording to %s" % self.path)
+
+    def _rotate(self):
+        self._close()
+        os.replace(self.path, self.path + '.1')
+        logging.info("* * * recording rotated to %s.1" % self.path)
+
+    def flush(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.flush()
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._close()
+
+
+def read_recording(path):
+    with open(path, 'rb') as raw:
+        compressed = raw.read(2) == GZIP_MAGIC
+    with (gzip.open(path, 'rb') if compressed else open(path, 'rb')) as file:
+        if file.read(len(MAGIC)) != MAGIC:
+            raise ValueError("%s is not a recording" % path)
+        while True:
+            try:
+                header = file.read(RECORD.size)
+                if len(header) < RECORD.size:
+                    return
+                timestamp, topic_length, payload_length = RECORD.unpack(header)
+                topic = file.read(topic_length).decode() if topic_length else None
+                payload = file.read(payload_length)
+            except EOFError:
+                # the compressed stream of a recorder that did not close
+                return
+            if len(payload) < payload_length:
+                return
+            yield timestamp, topic, payload
+
+
+def replay(path, on_message, on_line, speed=1.0, stop=None):
+    # feeds a recording to the ingestion callbacks, keeping the recorded pace divided by speed,
+    # a speed of 0 replays as fast as possible
+    count = 0
+    first = None
+    start = time.monotonic()
+    for timestamp, topic, payload in read_recording(path):
+        if stop is not None and stop.is_set():
+            break
+        if speed > 0:
+            if first is None:
+                first = timestamp
+            delay = start + (timestamp - first) / speed - time.monotonic()
+            if delay > 0:
+                time.sleep(delay)
+        if topic is not None:
+            on_message(None, None, RecordedMessage(topic, payload))
+        else:
+            on_line(payload)
+        count += 1
+    logging.info("* * * replayed %d messages from %s" % (count, path))
+    return count
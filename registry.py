@@ -0,0 +1,145 @@
+import json
+import logging
+import time
+
+from filters import create_filter
+from topics import TopicTrie
+
+try:
+    import orjson
+
+    json_loads = orjson.loads
+except ImportError:
+    try:
+        import ujson
+
+        json_loads = ujson.loads
+    except ImportError:
+        json_loads = json.loads
+
+
+def device_key(model, channel):
+    # payloads of sensors without a channel give <model>_None, both for configured and discovered devices
+    return f'{model}_{channel}'
+
+
+def make_extractor(temperature_field, humidity_field='humidity', pressure_field='pressure_hPa'):
+    def extract(payload):
+        return {
+            'temperature': payload[temperature_field],
+            'humidity': payload.get(humidity_field),
+            'pressure': payload.get(pressure_field),
+        }
+    return extract
+
+
+class DeviceEntry:
+    def __init__(self, key, device, reading_filter=None):
+        self.key = key
+        self.device = device
+        self.extract = make_extractor(device.temperature_json_field)
+        self.filter = reading_filter
+
+    def decode(self, payload, data):
+        # data is the decoded payload
+        if self.filter is None:
+            return self.extract(data)
+        now = time.monotonic()
+        if self.filter.duplicate_window and self.filter.repeated(payload, now):
+            return None
+        return self.filter.apply(self.extract(data), now)
+
+    def accept(self, payload):
+        # payload already decoded
+        reading = self.extract(payload)
+        if self.filter is None:
+            return reading
+        return self.filter.apply(reading, time.monotonic())
+
+
+class DeviceRegistry:
+    # radio devices indexed by mqtt topic and by model/channel, built once from the configuration
+    # decode_topic and decode_line return the key and None for a reading that was filtered out
+    def __init__(self):
+        # topic -> {key: entry}, several sensors can share a topic like rtl_433/events
+        self.by_topic = {}
+        self.topics = TopicTrie()
+        self.by_id = {}
+        self.config = None
+        self._models = ()
+        self._line = None
+        self._line_time = 0
+        self._line_key = None
+
+    def configure(self, config):
+        # filters of devices added from now on
+        self.config = config
+
+    def add(self, device):
+        reading_filter = create_filter(self.config, device) if self.config is not None else None
+        entry = DeviceEntry(device_key(device.model, device.channel), device, reading_filter)
+        if device.topic:
+            entries = self.by_topic.get(device.topic)
+            if entries is None:
+                entries = self.by_topic[device.topic] = {}
+                self.topics.insert(device.topic, entries)
+            entries[entry.key] = entry
+        self.by_id[entry.key] = entry
+        self._update_models()
+        return entry
+
+    def remove(self, key):
+        entry = self.by_id.pop(key, None)
+        if entry is not None:
+            entries = self.by_topic.get(entry.device.topic)
+            if entries is not None and entries.get(key) is entry:
+                del entries[key]
+                if not entries:
+                    del self.by_topic[entry.device.topic]
+                    self.topics.remove(entry.device.topic)
+            self._update_models()
+        return entry
+
+    def _update_models(self):
+        self._models = tuple(set(('"%s"' % entry.device.model).encode() for entry in self.by_id.values()))
+
+    def decode_topic(self, topic, payload):
+        # the topic rejects unknown messages before the json decode, model and channel pick the device
+        # among those of every filter matching it, a rtl_433/+/2 filter only gets its own model
+        candidates = self.topics.match_all(topic)
+        if not candidates:
+            return None, None
+        data = json_loads(payload)
+        key = device_key(data.get("model"), data.get("channel"))
+        entry = None
+        for entries in candidates:
+            entry = entries.get(key)
+            if entry is not None:
+                break
+        if entry is None:
+            logging.debug("* * * Device not configured: %s", data.get("model"))
+            return None, None
+        return entry.key, entry.decode(payload, data)
+
+    def decode_line(self, line):
+        # skip records of other models before the full json decode
+        if not any(model in line for model in self._models):
+            return None, None
+        # rtl_433 prints the copies of a transmission one after the other
+        now = time.monotonic()
+        if line == self._line and now - self._line_time <= self._duplicate_window():
+            return self._line_key, None
+        self._line = line
+        self._line_time = now
+        self._line_key = None
+        payload = json_loads(line)
+        entry = self.by_id.get(device_key(payload.get("model"), payload.get("channel")))
+        if entry is None:
+            logging.debug("* * * Device not configured: %s", payload.get("model"))
+            self._line_key = None
+            return None, None
+        self._line_key = entry.key
+        return entry.key, entry.accept(payload)
+
+    def _duplicate_window(self):
+        return self.config.get_duplicate_window() if self.config is not None else 0
@@ -0,0 +1,217 @@
+import logging
+import time
+
+from gi.repository import GLib
+
+from metrics import update_duration
+from staleness import TimerWheel
+
+# seconds to wait before retrying a failed online fetch
+ONLINE_RETRY = 60
+# seconds between checks for aggregate members that stopped reporting
+AGGREGATE_EXPIRE_INTERVAL = 60
+
+
+class UpdateScheduler:
+    def __init__(self, config, aggregates=None):
+        self.services = {}
+        self.aggregates = aggregates
+        # ThermalSource read in one pass for all cpu and thermal zone devices
+        self.thermal = None
+        # deadline of every radio sensor, expired sensors are shown as disconnected
+        self.staleness = TimerWheel()
+        self.configure(config)
+
+        self._jobs = []
+        self._periodic = []
+        self._next_cpu = 0
+        self._next_online = 0
+        self._timer = None
+
+        if self.aggregates is not None:
+            self.every(AGGREGATE_EXPIRE_INTERVAL, self.expire_aggregates)
+
+    def configure(self, config):
+        self.config = config
+        self.cpu_interval = config.get_cpu_interval()
+        self.online_interval = config.get_interval() * 60
+        self.temperature_deadband = config.get_temperature_deadband()
+        self.humidity_deadband = config.get_humidity_deadband()
+
+        tick = config.get_tick()
+        if getattr(self, '_timer', None) is not None and tick != self.tick:
+            self.tick = tick
+            self.stop()
+            self.start()
+        self.tick = tick
+
+    def add(self, key, service):
+        self.services[key] = service
+        device = service.temperature
+        if device.is_online or device.is_cpu:
+            self._periodic.append(service)
+        elif not device.is_aggregate:
+            # a sensor that is never received goes stale as well
+            self._watch(key, device, time.monotonic())
+
+    def _watch(self, key, device, now):
+        timeout = self.config.get_stale_timeout(device.model)
+        if timeout > 0:
+            self.staleness.schedule(key, now + timeout)
+        else:
+            self.staleness.remove(key)
+
+    def remove(self, key):
+        service = self.services.pop(key, None)
+        self.staleness.remove(key)
+        if service in self._periodic:
+            self._periodic.remove(service)
+        if self.aggregates is not None:
+            self.publish_aggregates(self.aggregates.remove(key))
+        return service
+
+    def every(self, seconds, callback):
+        # generic periodic job run from the shared tick
+        self._jobs.append([seconds, callback, 0])
+
+    def start(self):
+        logging.info("* * * scheduler started: tick %ds, cpu %ds, online %ds"
+                     % (self.tick, self.cpu_interval, self.online_interval))
+        self._timer = GLib.timeout_add_seconds(self.tick, self._tick)
+
+    def stop(self):
+        if self._timer is not None:
+            GLib.source_remove(self._timer)
+            self._timer = None
+
+    def _tick(self):
+        start = time.perf_counter()
+        try:
+            return self._run_tick()
+        finally:
+            update_duration.observe(time.perf_counter() - start)
+
+    def _run_tick(self):
+        now = time.monotonic()
+
+        for job in self._jobs:
+            if now >= job[2]:
+                job[2] = now + job[0]
+                try:
+                    job[1]()
+                except Exception:
+                    logging.exception("Error in scheduled job")
+
+        changed = set()
+        run_cpu = now >= self._next_cpu
+        run_online = now >= self._next_online
+        thermal = {}
+        if run_cpu:
+            self._next_cpu = now + self.cpu_interval
+            if self.thermal is not None:
+                thermal = self.thermal.read()
+
+        # radio sensors are not polled, they are published by apply_readings
+        for service in self._periodic:
+            try:
+                if service.temperature.is_online:
+                    if not run_online:
+                        continue
+                    # the fetch runs in background, _on_weather publishes the result
+                    if service.update_online(lambda conditions, s=service: self._on_weather(s, conditions)):
+                        self._next_online = now + self.online_interval
+                    else:
+                        self._next_online = now + ONLINE_RETRY
+                    continue
+                else:
+                    if not run_cpu:
+                        continue
+                    with service.changes():
+                        service.update_cpu(thermal.get(service.temperature.thermal_zone))
+                        service.record_history()
+                        if service.publish_changed(self.temperature_deadband, self.humidity_deadband):
+                            changed.add(service)
+            except Exception:
+                logging.exception("Error updating %s" % service.dbusservice.name)
+
+        self.update_aggregates(changed, now)
+
+        for key in self.staleness.advance(now):
+            self._expire(key)
+        return True
+
+    def _expire(self, key):
+        service = self.services.get(key)
+        if service is None:
+            return
+        logging.info("* * * %s not received for %ds, disconnected"
+                     % (service.temperature.name, time.monotonic() - (service.temperature.last_seen or 0)))
+        with service.changes():
+            service.set_connected(False)
+        if self.aggregates is not None:
+            self.publish_aggregates(self.aggregates.remove(key))
+
+    def _on_weather(self, service, conditions):
+        with service.changes():
+            if not service.apply_weather(conditions):
+                self._next_online = time.monotonic() + ONLINE_RETRY
+                return
+            service.temperature.last_seen = time.monotonic()
+            if not service.connected:
+                service.set_connected(True)
+            service.publish()
+            service.record_history()
+        self.update_aggregates([service], time.monotonic())
+
+    def apply_readings(self, readings):
+        now = time.monotonic()
+        changed = []
+        for key, reading in readings.items():
+            service = self.services.get(key)
+            if service is None:
+                continue
+            device = service.temperature
+            device.temperature = reading['temperature']
+            device.humidity = reading['humidity']
+            if reading['pressure'] is not None:
+                device.pressure = reading['pressure']
+            device.last_seen = now
+            self._watch(key, device, now)
+
+            with service.changes():
+                service.record_history()
+                if service.publish_changed(self.temperature_deadband, self.humidity_deadband) \
+                        or not service.connected:
+                    changed.append(service)
+                if not service.connected:
+                    logging.info("* * * %s received again, connected" % device.name)
+                    service.set_connected(True)
+
+        self.update_aggregates(changed, now)
+
+    def update_aggregates(self, services, now):
+        if self.aggregates is None or not services:
+            return
+        groups = set()
+        for service in services:
+            groups |= self.aggregates.update(service.key, service.temperature, now)
+        self.publish_aggregates(groups)
+
+    def expire_aggregates(self):
+        self.publish_aggregates(self.aggregates.expire(time.monotonic()))
+
+    def publish_aggregates(self, groups):
+        for group in groups:
+            aggregate_instance = self.services.get(group.key)
+            if aggregate_instance is None:
+                continue
+            temperature, humidity = group.values()
+            logging.debug("* * * %s: %d instances", group.name, len(group.members))
+            aggregate_instance.temperature.temperature = temperature
+            aggregate_instance.temperature.humidity = humidity
+            aggregate_instance.temperature.last_seen = time.monotonic()
+            with aggregate_instance.changes():
+                if not aggregate_instance.connected and temperature is not None:
+                    aggregate_instance.set_connected(True)
+                aggregate_instance.record_history()
+                aggregate_instance.publish_changed(self.temperature_deadband, self.humidity_deadband)
@@ -0,0 +1,65 @@
+import logging
+
+
+class TimerWheel:
+    # hashed timer wheel of deadlines, keyed by the tick they fall in. A new reading only
+    # moves the deadline of its key, the key is looked at again when its old tick comes
+    # round, so a tick costs the same whatever the number of sensors
+    def __init__(self, resolution=1):
+        self.resolution = resolution
+        self.deadlines = {}
+        # tick -> keys to check in that tick
+        self._slots = {}
+        # key -> tick it is scheduled in
+        self._scheduled = {}
+        self._current = None
+
+    def _tick_of(self, t):
+        return int(t // self.resolution)
+
+    def schedule(self, key, deadline):
+        self.deadlines[key] = deadline
+        tick = self._scheduled.get(key)
+        # a later deadline is picked up when the scheduled tick comes round
+        if tick is None or self._tick_of(deadline) < tick:
+            self._insert(key, deadline)
+
+    def _insert(self, key, deadline):
+        old = self._scheduled.get(key)
+        if old is not None:
+            self._slots[old].discard(key)
+        tick = self._tick_of(deadline)
+        if self._current is not None:
+            tick = max(tick, self._current + 1)
+        self._slots.setdefault(tick, set()).add(key)
+        self._scheduled[key] = tick
+
+    def remove(self, key):
+        self.deadlines.pop(key, None)
+        tick = self._scheduled.pop(key, None)
+        if tick is not None:
+            self._slots[tick].discard(key)
+
+    def advance(self, now):
+        target = self._tick_of(now)
+        if self._current is None:
+            self._current = target - 1
+        if target - self._current > len(self._slots):
+            # after a long pause visiting the used ticks is cheaper than every tick in between
+            ticks = sorted(tick for tick in self._slots if tick <= target)
+        else:
+            ticks = range(self._current + 1, target + 1)
+        self._current = max(self._current, target)
+
+        expired = []
+        for tick in ticks:
+            for key in self._slots.pop(tick, ()):
+                del self._scheduled[key]
+                if self.deadlines[key] <= now:
+                    del self.deadlines[key]
+                    expired.append(key)
+                else:
+                    self._insert(key, self.deadlines[key])
+        if expired:
+            logging.debug("* * * stale: %s", expired)
+        return expired
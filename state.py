@@ -0,0 +1,92 @@
+import json
+import logging
+import os
+import time
+from datetime import datetime
+
+
+class DeviceState:
+    # latest values of every device, saved periodically so that after a restart the
+    # services register with them instead of empty values
+    def __init__(self, path, max_age):
+        self.path = path
+        self.max_age = max_age
+        # key -> saved state, as loaded and for devices not updated since
+        self.devices = {}
+        self._written = None
+
+    def load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as file:
+                devices = json.load(file)
+        except (OSError, ValueError):
+            logging.exception("Error reading device state %s" % self.path)
+            return
+        oldest = time.time() - self.max_age
+        self.devices = {key: state for key, state in devices.items() if state.get("updated", 0) >= oldest}
+        logging.info("* * * restored state of %d devices" % len(self.devices))
+
+    def restore(self, key, device):
+        state = self.devices.get(key)
+        if state is None:
+            return None
+        device.temperature = state.get("temperature")
+        device.humidity = state.get("humidity")
+        device.pressure = state.get("pressure")
+        # saved as seconds since the epoch, a datetime is not json serializable
+        last_update = state.get("last_update")
+        device.last_update = datetime.fromtimestamp(last_update) if last_update is not None else None
+        # a type changed on dbus survives the restart, unless the configuration changed it since
+        if state.get("device_type") is not None and state.get("configured_type") == device.device_type:
+            device.device_type = state["device_type"]
+        return state
+
+    def collect(self, services):
+        now = time.time()
+        monotonic = time.monotonic()
+        devices = {}
+        for key, service in services.items():
+            device = service.temperature
+            if device.is_cpu:
+                continue
+            if device.last_seen is None:
+                # nothing received since the start, keep what was restored
+                if key in self.devices:
+                    devices[key] = dict(self.devices[key], device_type=device.device_type,
+                                        configured_type=service.configured_type)
+                continue
+            devices[key] = {
+                "temperature": device.temperature,
+                "humidity": device.humidity,
+                "pressure": device.pressure,
+                "last_update": device.last_update.timestamp() if device.last_update is not None else None,
+                "name": device.name,
+                "device_type": device.device_type,
+                "configured_type": service.configured_type,
+                "updated": round(now - (monotonic - device.last_seen)),
+            }
+        return devices
+
+    def save(self, services):
+        devices = self.collect(services)
+        try:
+            content = json.dumps(devices, sort_keys=True)
+        except (TypeError, ValueError):
+            logging.exception("Error serializing device state")
+            return
+        if content == self._written:
+            return
+        # written to a temporary file and renamed, a crash leaves either the old or the new state
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, 'w') as file:
+                file.write(content)
+                file.flush()
+                os.fsync(file.fileno())
+            os.replace(tmp, self.path)
+            self.devices = devices
+            self._written = content
+        except OSError:
+            logging.exception("Error writing device state %s" % self.path)
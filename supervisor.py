@@ -0,0 +1,223 @@
+import ctypes
+import ctypes.util
+import logging
+import os
+import signal
+import time
+
+from gi.repository import GLib
+
+# a child that stayed up this long is considered healthy again
+STABLE_UPTIME = 60
+# longest stdout line kept while waiting for its newline
+MAX_LINE = 65536
+PR_SET_PDEATHSIG = 1
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except OSError:
+    _libc = None
+
+
+def _die_with_parent():
+    # runs in the child between fork and exec: the kernel sends rtl_433 a SIGTERM when
+    # the service dies without stopping it, so no stale rtl_433 keeps the dongle busy
+    _libc.prctl(PR_SET_PDEATHSIG, signal.SIGTERM)
+
+
+class Rtl433Supervisor:
+    def __init__(self, command, backoff=1, backoff_max=300, crash_loop_limit=5, crash_loop_cooldown=600,
+                 on_line=None, name='rtl_433'):
+        self.command = command
+        self.name = name
+        # when set rtl_433 prints json records on stdout and each line is handed to on_line
+        self.on_line = on_line
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.crash_loop_limit = crash_loop_limit
+        self.crash_loop_cooldown = crash_loop_cooldown
+
+        self.pid = None
+        self.started_at = None
+        self.restarts = 0
+        self.failures = 0
+        self.listeners = []
+
+        self._watch = None
+        self._stdout = None
+        self._stdout_watch = None
+        self._buffer = b''
+        self._restart_timer = None
+        self._stopping = False
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def uptime(self):
+        if self.started_at is None:
+            return 0
+        return int(time.monotonic() - self.started_at)
+
+    def start(self):
+        self._stopping = False
+        self._spawn()
+
+    def stop(self):
+        self._stopping = True
+        if self._restart_timer is not None:
+            GLib.source_remove(self._restart_timer)
+            self._restart_timer = None
+        if self.pid is not None:
+            logging.info("* * * stopping %s (pid %d)" % (self.name, self.pid))
+            try:
+                os.kill(self.pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    def _spawn(self):
+        self._restart_timer = None
+        flags = GLib.SpawnFlags.DO_NOT_REAP_CHILD | GLib.SpawnFlags.STDERR_TO_DEV_NULL
+        command = list(self.command)
+        if self.on_line is None:
+            flags |= GLib.SpawnFlags.STDOUT_TO_DEV_NULL
+        else:
+            command += ['-F', 'json']
+        try:
+            pid, _, stdout, _ = GLib.spawn_async(command, flags=flags,
+                                                 child_setup=_die_with_parent if _libc is not None else None,
+                                                 standard_output=self.on_line is not None)
+        except GLib.Error:
+            logging.exception("Error starting %s" % self.name)
+            self._schedule_restart()
+            return False
+
+        self.pid = pid
+        if self.on_line is not None:
+            self._open_stdout(stdout)
+        self.started_at = time.monotonic()
+        self._watch = GLib.child_watch_add(GLib.PRIORITY_DEFAULT, pid, self._on_exit)
+        logging.info("* * * %s started (pid %d)" % (self.name, pid))
+        self._notify()
+        return False
+
+    def _open_stdout(self, fd):
+        os.set_blocking(fd, False)
+        self._stdout = fd
+        self._buffer = b''
+        self._stdout_watch = GLib.io_add_watch(
+            fd, GLib.PRIORITY_DEFAULT, GLib.IOCondition.IN | GLib.IOCondition.HUP | GLib.IOCondition.ERR,
+            self._on_stdout)
+
+    def _close_stdout(self):
+        if self._stdout_watch is not None:
+            GLib.source_remove(self._stdout_watch)
+            self._stdout_watch = None
+        if self._stdout is not None:
+            os.close(self._stdout)
+            self._stdout = None
+        self._buffer = b''
+
+    def _on_stdout(self, fd, condition):
+        try:
+            data = os.read(fd, MAX_LINE)
+        except BlockingIOError:
+            return True
+        except OSError:
+            logging.exception("Error reading %s output" % self.name)
+            data = b''
+
+        if not data:
+            # rtl_433 closed its stdout, the child watch takes care of the restart
+            self._stdout_watch = None
+            self._close_stdout()
+            return False
+
+        lines = (self._buffer + data).split(b'\n')
+        self._buffer = lines.pop()
+        if len(self._buffer) > MAX_LINE:
+            logging.warning("%s output line too long, dropped" % self.name)
+            self._buffer = b''
+
+        for line in lines:
+            if line:
+                try:
+                    self.on_line(line)
+                except Exception:
+                    logging.exception("Error handling %s output" % self.name)
+        return True
+
+    def _on_exit(self, pid, status):
+        GLib.spawn_close_pid(pid)
+        self._close_stdout()
+        uptime = self.uptime()
+        self.pid = None
+        self.started_at = None
+        self._watch = None
+
+        if self._stopping:
+            logging.info("* * * %s stopped" % self.name)
+            self._notify()
+            return
+
+        logging.warning("%s (pid %d) exited with status %d after %ds" % (self.name, pid, status, uptime))
+        if uptime >= STABLE_UPTIME:
+            self.failures = 0
+        self._schedule_restart()
+        self._notify()
+
+    def _schedule_restart(self):
+        self.failures += 1
+        self.restarts += 1
+        if self.failures > self.crash_loop_limit:
+            delay = self.crash_loop_cooldown
+            self.failures = 0
+            logging.error("%s is crash looping, waiting %ds before the next start" % (self.name, delay))
+        else:
+            delay = min(self.backoff * 2 ** (self.failures - 1), self.backoff_max)
+            logging.info("* * * restarting %s in %ds" % (self.name, delay))
+        self._restart_timer = GLib.timeout_add_seconds(delay, self._spawn)
+
+    def _notify(self):
+        for listener in self.listeners:
+            try:
+                listener(self)
+            except Exception:
+                logging.exception("Error in rtl_433 supervisor listener")
+
+
+class Rtl433Pool:
+    # one supervisor per receiver, seen by the services as a single rtl_433
+    def __init__(self, supervisors):
+        self.supervisors = supervisors
+        self.listeners = []
+        for supervisor in supervisors:
+            supervisor.add_listener(self._notify)
+
+    @property
+    def restarts(self):
+        return sum(supervisor.restarts for supervisor in self.supervisors)
+
+    def running(self):
+        return sum(1 for supervisor in self.supervisors if supervisor.pid is not None)
+
+    def add_listener(self, callback):
+        self.listeners.append(callback)
+
+    def uptime(self):
+        # uptime of the receiver started last, 0 while any of them is down
+        return min(supervisor.uptime() for supervisor in self.supervisors)
+
+    def start(self):
+        for supervisor in self.supervisors:
+            supervisor.start()
+
+    def stop(self):
+        for supervisor in self.supervisors:
+            supervisor.stop()
+
+    def _notify(self, supervisor):
+        for listener in self.listeners:
+            try:
+                listener(self)
+            except Exception:
+                logging.exception("Error in rtl_433 supervisor listener")
@@ -22,8 +22,12 @@ class Temperature:
         self.is_online = is_online
         self.is_aggregate = False
         self.is_cpu = False
-        self.cpu_path = None
+        self.thermal_zone = None
+        # smoothing of the readings, None for the [Filters] default
+        self.smoothing = None
         self.last_update = None
+        # monotonic time of the last reading received
+        self.last_seen = None
 
         self.temperature = temperature
         self.humidity = humidity
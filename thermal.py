@@ -0,0 +1,117 @@
+import glob
+import logging
+import os
+import re
+
+THERMAL_ZONES = '/sys/class/thermal/thermal_zone*/temp'
+HWMON_INPUTS = '/sys/class/hwmon/hwmon*/temp*_input'
+
+
+def _read_text(path):
+    try:
+        with open(path, 'r') as file:
+            return file.read().strip()
+    except OSError:
+        return None
+
+
+def _normalize(name):
+    # same as Temperature.normalize_name
+    return re.sub(r'[^a-zA-Z0-9]', '_', name)
+
+
+def _is_thermal_mirror(directory, chip, thermal_types):
+    # the kernel exports every thermal zone again as an hwmon chip, parented to the zone
+    # and named after its type
+    parent = os.path.basename(os.path.realpath(os.path.join(directory, 'device')))
+    return parent.startswith('thermal_zone') or (chip is not None and _normalize(chip) in thermal_types)
+
+
+class ThermalZone:
+    def __init__(self, zone_id, name, path):
+        self.zone_id = zone_id
+        self.name = name
+        self.path = path
+        self.fd = None
+
+    def open(self):
+        try:
+            self.fd = os.open(self.path, os.O_RDONLY)
+        except OSError:
+            logging.exception("Error opening %s" % self.path)
+            self.fd = None
+        return self.fd is not None
+
+    def read(self):
+        if self.fd is None and not self.open():
+            return None
+        try:
+            # sysfs regenerates the value on every read from offset 0
+            return round(int(os.pread(self.fd, 16, 0)) / 1000.0, 1)
+        except (OSError, ValueError):
+            logging.debug("* * * %s not readable", self.path)
+            self.close()
+            return None
+
+    def close(self):
+        if self.fd is not None:
+            os.close(self.fd)
+            self.fd = None
+
+
+class ThermalSource:
+    # discovers thermal zones and hwmon temperature inputs once and keeps them open
+    def __init__(self):
+        self.zones = {}
+        self.values = {}
+        # normalized names in use, each zone becomes a dbus service named after it
+        self._names = set()
+
+    def discover(self):
+        thermal_types = set()
+        for path in sorted(glob.glob(THERMAL_ZONES)):
+            directory = os.path.dirname(path)
+            zone_id = os.path.basename(directory)
+            name = _read_text(os.path.join(directory, 'type')) or zone_id
+            thermal_types.add(_normalize(name))
+            self._add(ThermalZone(zone_id, self._unique(name, zone_id), path))
+
+        for path in sorted(glob.glob(HWMON_INPUTS)):
+            directory = os.path.dirname(path)
+            sensor = re.sub(r'_input$', '', os.path.basename(path))
+            zone_id = '%s_%s' % (os.path.basename(directory), sensor)
+            label = _read_text(os.path.join(directory, sensor + '_label'))
+            chip = _read_text(os.path.join(directory, 'name'))
+            if label is None and _is_thermal_mirror(directory, chip, thermal_types):
+                logging.debug("* * * %s mirrors a thermal zone, skipped", zone_id)
+                continue
+            self._add(ThermalZone(zone_id, self._unique(label or chip or zone_id, zone_id), path))
+
+        logging.info("* * * thermal zones: %s" % ", ".join(self.zones.keys()))
+        return self.zones
+
+    def _unique(self, name, zone_id):
+        if _normalize(name) in self._names:
+            name = '%s %s' % (name, zone_id)
+        return name
+
+    def _add(self, zone):
+        if zone.open():
+            self.zones[zone.zone_id] = zone
+            self._names.add(_normalize(zone.name))
+
+    def first(self):
+        # thermal_zone0 is the cpu temperature on the cerbo gx and the raspberry pi
+        if 'thermal_zone0' in self.zones:
+            return self.zones['thermal_zone0']
+        return next(iter(self.zones.values()), None)
+
+    def read(self):
+        values = self.values
+        for zone_id, zone in self.zones.items():
+            values[zone_id] = zone.read()
+        return values
+
+    def close(self):
+        for zone in self.zones.values():
+            zone.close()
@@ -0,0 +1,59 @@
+_VALUE = object()
+
+
+class TopicTrie:
+    # maps mqtt topic filters, + and # wildcards included, to values; one level per node
+    def __init__(self):
+        self._root = {}
+        self._size = 0
+
+    def __len__(self):
+        return self._size
+
+    def insert(self, topic, value):
+        node = self._root
+        for level in topic.split('/'):
+            node = node.setdefault(level, {})
+        if _VALUE not in node:
+            self._size += 1
+        node[_VALUE] = value
+
+    def remove(self, topic):
+        path = [self._root]
+        for level in topic.split('/'):
+            node = path[-1].get(level)
+            if node is None:
+                return None
+            path.append(node)
+        value = path[-1].pop(_VALUE, None)
+        if value is not None:
+            self._size -= 1
+        # prune empty nodes
+        levels = topic.split('/')
+        for i in range(len(levels), 0, -1):
+            if path[i]:
+                break
+            del path[i - 1][levels[i - 1]]
+        return value
+
+    def match_all(self, topic):
+        # values of every filter matching the topic, exact levels first
+        values = []
+        self._match_all(self._root, topic.split('/'), 0, values)
+        return values
+
+    def _match_all(self, node, levels, i, values):
+        if i == len(levels):
+            if _VALUE in node:
+                values.append(node[_VALUE])
+        else:
+            child = node.get(levels[i])
+            if child is not None:
+                self._match_all(child, levels, i + 1, values)
+            child = node.get('+')
+            if child is not None:
+                self._match_all(child, levels, i + 1, values)
+        # # also matches the parent level
+        child = node.get('#')
+        if child is not None and _VALUE in child:
+            values.append(child[_VALUE])
@@ -0,0 +1,69 @@
+import logging
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from gi.repository import GLib
+
+from metrics import provider_failures, provider_latency
+
+
+class WeatherFetcher:
+    # runs the blocking provider calls on a worker thread and hands the
+    # conditions back to the GLib main loop
+    def __init__(self, provider, cache=None):
+        self.provider = provider
+        self.cache = cache
+        self.provider.cache = cache
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="weather")
+        self._future = None
+
+    def busy(self):
+        return self._future is not None and not self._future.done()
+
+    def fetch(self, latitude, longitude, callback):
+        if self.busy():
+            logging.debug("* * * weather fetch already running")
+            return False
+
+        cell = None
+        if self.cache is not None:
+            cell = self.cache.cell(latitude, longitude)
+            conditions = self.cache.get_conditions(cell)
+            if conditions is not None:
+                logging.debug("* * * cached weather for cell %s", cell)
+                GLib.idle_add(self._cached, conditions, callback)
+                return True
+
+        self._future = self._executor.submit(self._fetch, latitude, longitude, cell)
+        self._future.add_done_callback(lambda future: GLib.idle_add(self._done, future, callback))
+        return True
+
+    def _fetch(self, latitude, longitude, cell):
+        start = time.perf_counter()
+        self.provider.get_weather(latitude, longitude)
+        provider_latency.observe(time.perf_counter() - start)
+        conditions = dict(self.provider.conditions)
+        if not conditions.get("valid"):
+            provider_failures.inc()
+        if self.cache is not None and conditions.get("valid"):
+            self.cache.put_conditions(cell, conditions)
+        return conditions
+
+    @staticmethod
+    def _cached(conditions, callback):
+        callback(conditions)
+        return False
+
+    @staticmethod
+    def _done(future, callback):
+        try:
+            conditions = future.result()
+        except Exception:
+            logging.exception("Failed to get weather data")
+            conditions = {"valid": False}
+        callback(conditions)
+        return False
+
+    def shutdown(self):
+        self._executor.shutdown(wait=False)
+        self.provider.shutdown()
@@ -0,0 +1,119 @@
+import json
+import logging
+import os
+import threading
+import time
+from datetime import datetime
+
+_BASE32 = "0123456789bcdefghjkmnpqrstuvwxyz"
+
+
+def geohash(latitude, longitude, precision=5):
+    lat_range = [-90.0, 90.0]
+    lon_range = [-180.0, 180.0]
+    cell = []
+    bits = 0
+    bit = 0
+    even = True
+    while len(cell) < precision:
+        if even:
+            mid = (lon_range[0] + lon_range[1]) / 2
+            if longitude >= mid:
+                bits = bits * 2 + 1
+                lon_range[0] = mid
+            else:
+                bits = bits * 2
+                lon_range[1] = mid
+        else:
+            mid = (lat_range[0] + lat_range[1]) / 2
+            if latitude >= mid:
+                bits = bits * 2 + 1
+                lat_range[0] = mid
+            else:
+                bits = bits * 2
+                lat_range[1] = mid
+        even = not even
+        bit += 1
+        if bit == 5:
+            cell.append(_BASE32[bits])
+            bits = 0
+            bit = 0
+    return "".join(cell)
+
+
+class WeatherCache:
+    # conditions and nearest station per position cell, persisted on disk so
+    # they survive restarts; accessed from the main loop and the weather worker
+    def __init__(self, path, precision=5, ttl=600, max_cells=256):
+        self.path = path
+        self.precision = precision
+        self.ttl = ttl
+        self.max_cells = max_cells
+        self._lock = threading.Lock()
+        self._stations = {}
+        self._conditions = {}
+        self._load()
+
+    def cell(self, latitude, longitude):
+        return geohash(latitude, longitude, self.precision)
+
+    def get_station(self, cell):
+        with self._lock:
+            return self._stations.get(cell)
+
+    def put_station(self, cell, station):
+        with self._lock:
+            if self._stations.get(cell) == station:
+                return
+            self._stations[cell] = station
+            self._trim(self._stations)
+        self._save()
+
+    def drop_station(self, cell):
+        with self._lock:
+            if self._stations.pop(cell, None) is None:
+                return
+        self._save()
+
+    def get_conditions(self, cell):
+        with self._lock:
+            conditions = self._conditions.get(cell)
+        if conditions is None or time.time() - conditions["time"] > self.ttl:
+            return None
+        result = dict(conditions)
+        result["last_update"] = datetime.fromtimestamp(result.pop("time"))
+        return result
+
+    def put_conditions(self, cell, conditions):
+        stored = {k: v for k, v in conditions.items() if k != "last_update"}
+        stored["time"] = time.time()
+        with self._lock:
+            self._conditions[cell] = stored
+            self._trim(self._conditions)
+        self._save()
+
+    def _trim(self, cells):
+        while len(cells) > self.max_cells:
+            del cells[next(iter(cells))]
+
+    def _load(self):
+        if not os.path.exists(self.path):
+            return
+        try:
+            with open(self.path, 'r') as file:
+                data = json.load(file)
+            self._stations = data.get("stations", {})
+            self._conditions = data.get("conditions", {})
+        except (OSError, ValueError):
+            logging.exception("Error reading weather cache %s" % self.path)
+
+    def _save(self):
+        with self._lock:
+            data = json.dumps({"stations": self._stations, "conditions": self._conditions})
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, 'w') as file:
+                file.write(data)
+            os.replace(tmp, self.path)
+        except OSError:
+            logging.exception("Error writing weather cache %s" % self.path)